@@ -1,5 +1,3 @@
-import asyncio
-import contextlib
 import json
 import logging
 import os
@@ -7,26 +5,10 @@ import sys
 from pathlib import Path
 
 import gs6ex
+from gs6ex import logs
 
 
-@contextlib.contextmanager
-def logger(name, level):
-    l = logging.getLogger(name)
-    l.setLevel(level)
-
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(logging.Formatter('[%(asctime)s] (%(levelname)s) %(name)s: %(message)s'))
-
-    l.addHandler(handler)
-
-    yield l
-
-    for hdlr in l.handlers[:]:
-        l.removeHandler(hdlr)
-        hdlr.close()
-
-
-with logger('discord', logging.WARNING), logger('bot', logging.INFO) as log:
+with logs.LogPipeline({'discord': logging.WARNING, 'bot': logging.INFO}):
     if len(sys.argv) != 2:
         sys.exit('Usage: python3 -m gs6ex <profile>')
     
@@ -0,0 +1,60 @@
+"""Round-trip check and throughput benchmark for the base32768 codec
+
+Compares the block codec against the scalar (one byte/char at a time) functions.
+Run from the directory containing the gs6ex folder:
+
+    python -m gs6ex.benchmarks.base32768
+"""
+
+import os
+import time
+
+from ..modules import compress as cc
+
+
+sizes = (16, 300, 4_000, 64_000, 1_000_000)
+
+
+def check_round_trip():
+    for size in (*range(0, 64), 15 * cc.slab_blocks - 1, 15 * cc.slab_blocks, 15 * cc.slab_blocks + 1):
+        data = os.urandom(size)
+        encoded = cc._base32768_encode_raw(data)
+
+        assert encoded == cc._base32768_encode_scalar(data), f'Encoded output differs for {size} bytes'
+        assert cc._base32768_decode_raw(encoded) == data, f'Round trip failed for {size} bytes'
+
+
+def throughput(func, data, min_time=0.5):
+    runs = 0
+    start = time.perf_counter()
+
+    while (elapsed := time.perf_counter() - start) < min_time:
+        func(data)
+        runs += 1
+
+    return runs * len(data) / elapsed
+
+
+def main():
+    check_round_trip()
+    print('Round trip OK\n')
+
+    print(f'{"bytes":>9}  {"op":<6} {"scalar":>12} {"block":>12} {"speedup":>8}')
+
+    for size in sizes:
+        data = os.urandom(size)
+        encoded = cc._base32768_encode_raw(data)
+
+        for op, scalar, block, arg in (
+            ('encode', cc._base32768_encode_scalar, cc._base32768_encode_raw, data),
+            ('decode', cc._base32768_decode_scalar, cc._base32768_decode_raw, encoded),
+        ):
+            # Throughput is always reported in raw bytes per second
+            scale = len(data) / len(arg)
+            old = throughput(scalar, arg) * scale
+            new = throughput(block, arg) * scale
+            print(f'{size:>9}  {op:<6} {old / 1e6:>9.2f} MB/s {new / 1e6:>9.2f} MB/s {new / old:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Compares compression ratio and encode/decode time of every codec in modules/compress.py
+
+The samples are slices of the asyncio package sources, which look like the code that gets sent
+through execc, but aren't part of the shared dictionary.
+Run from the directory containing the gs6ex folder:
+
+    python -m gs6ex.benchmarks.compression
+"""
+
+import time
+import asyncio
+from pathlib import Path
+
+from ..modules import compress as cc
+
+
+def samples():
+    sources = b'\n'.join(p.read_bytes() for p in sorted(Path(asyncio.__file__).parent.glob('*.py')))
+
+    yield 'one-liner', b"await ctx.send(bot.modules['core'].conf.systemd_service_name)"
+
+    for size in (300, 2_000, 16_000, 100_000, 1_000_000):
+        yield f'{size} bytes', sources[:size]
+
+
+def timed(func, arg, min_time=0.2):
+    runs = 0
+    start = time.perf_counter()
+
+    while (elapsed := time.perf_counter() - start) < min_time:
+        result = func(arg)
+        runs += 1
+
+    return result, elapsed / runs
+
+
+def main():
+    print(f'{"sample":<15} {"codec":<13} {"chars":>8} {"ratio":>6} {"encode":>10} {"decode":>10}')
+
+    for sample_name, data in samples():
+        auto = cc.choose_codec(len(data))
+
+        for codec in cc.codecs.values():
+            encoded, encode_time = timed(lambda d: cc.base32768_encode_bytes(d, codec), data)
+            decoded, decode_time = timed(cc.base32768_decode_bytes, encoded)
+            assert decoded == data, f'Round trip failed for {codec.name}'
+
+            # Each char carries 15 bits, so the ratio is measured in bits
+            ratio = len(encoded) * 15 / (len(data) * 8)
+            marker = '*' if codec is auto else ' '
+            print(f'{sample_name:<15} {codec.name:<12}{marker} {len(encoded):>8} {ratio:>6.3f} {encode_time * 1e3:>7.2f} ms {decode_time * 1e3:>7.2f} ms')
+
+        print()
+
+    print('* chosen automatically for this size')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Concurrency benchmark for the database layer
+
+Runs a mixed workload (many concurrent readers, one task committing small writes)
+against a single aiosqlite connection in rollback journal mode, which is what the bot
+used to do, and against database.Database with WAL and shared reader connections.
+The writer commits as fast as it can, and then at a fixed rate closer to what the bot does.
+Run from the directory containing the gs6ex folder:
+
+    python -m gs6ex.benchmarks.database
+"""
+
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+
+import aiosqlite
+
+from .. import database
+
+
+num_rows = 20_000
+num_readers = 16
+duration = 3.0
+# Commits per second in the second run, None is as fast as possible
+write_rates = (None, 20)
+
+read_sql = 'SELECT count(*), sum(value) FROM items WHERE owner = ?;'
+write_sql = 'INSERT INTO items (owner, value) VALUES (?, ?);'
+
+
+class SingleConnection:
+    # The old setup: one connection, everything goes through it
+    def __init__(self, path):
+        self.path = path
+
+    async def connect(self):
+        self.conn = await aiosqlite.connect(self.path)
+        return self
+
+    async def fetchone(self, sql, parameters=()):
+        async with self.conn.execute(sql, parameters) as cursor:
+            return await cursor.fetchone()
+
+    async def write(self, parameters):
+        await self.conn.execute(write_sql, parameters)
+        await self.conn.commit()
+
+    async def close(self):
+        await self.conn.close()
+
+
+class Pooled(database.Database):
+    async def write(self, parameters):
+        async with self.transaction() as tx:
+            await tx.execute(write_sql, parameters)
+
+
+async def setup(path):
+    async with aiosqlite.connect(path) as conn:
+        await conn.execute('CREATE TABLE items (id INTEGER PRIMARY KEY, owner INTEGER NOT NULL, value INTEGER NOT NULL);')
+        await conn.execute('CREATE INDEX items_owner ON items (owner);')
+        await conn.executemany(write_sql, ((i % 100, i) for i in range(num_rows)))
+        await conn.commit()
+
+
+async def run(db, write_rate):
+    reads = writes = 0
+    deadline = time.perf_counter() + duration
+
+    async def reader(owner):
+        nonlocal reads
+        while time.perf_counter() < deadline:
+            await db.fetchone(read_sql, (owner, ))
+            reads += 1
+
+    async def writer():
+        nonlocal writes
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await db.write((writes % 100, writes))
+            writes += 1
+
+            if write_rate is not None:
+                await asyncio.sleep(max(0.0, 1 / write_rate - (time.perf_counter() - start)))
+
+    await asyncio.gather(writer(), *(reader(i) for i in range(num_readers)))
+    return reads / duration, writes / duration
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        for write_rate in write_rates:
+            print(f'Writer committing {"as fast as it can" if write_rate is None else f"{write_rate} times per second"}:')
+
+            for name, make_db in (
+                ('single connection', lambda path: SingleConnection(path)),
+                ('WAL, 1 reader', lambda path: Pooled(path, readers=1)),
+                ('WAL, 2 readers', lambda path: Pooled(path, readers=2)),
+                ('WAL, 4 readers', lambda path: Pooled(path, readers=4)),
+                ('WAL, 8 readers', lambda path: Pooled(path, readers=8)),
+            ):
+                path = Path(tmp) / f'{name} {write_rate}.db'
+                await setup(path)
+
+                db = await make_db(path).connect()
+                reads, writes = await run(db, write_rate)
+                await db.close()
+
+                print(f'  {name:<20} {reads:>9.0f} reads/s {writes:>7.0f} commits/s')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,106 @@
+"""Replay benchmark for the message dispatch path
+
+Feeds a stream of fake messages, most of which aren't commands, through Gs6Ex.on_message
+and compares it with the old dispatch path (no pre-filter, regex based get_context).
+Run from the directory containing the gs6ex folder:
+
+    python -m gs6ex.benchmarks.dispatch
+"""
+
+import re
+import time
+import random
+import asyncio
+from types import SimpleNamespace
+
+import discord.ext.commands as cmd
+from discord.ext.commands.view import StringView
+
+from .. import Gs6Ex
+
+
+num_messages = 100_000
+command_ratio = 0.01
+bot_id = 123456789012345678
+
+
+class OldGs6Ex(Gs6Ex):
+    # The dispatch path as it was before the pre-filter
+    async def on_message(self, message):
+        await self.process_commands(message)
+
+    async def get_context(self, message, *, cls=cmd.Context):
+        cmd_regex = self.command_dms_regex if message.guild is None else self.command_regex
+        match = cmd_regex.match(message.content)
+
+        if not match:
+            return cls(prefix=None, view=None, bot=self, message=message)
+
+        view = StringView(match.group(1).strip())
+        ctx = cls(prefix=None, view=view, bot=self, message=message)
+
+        if self._skip_check(message.author.id, self.user.id):
+            return ctx
+
+        invoker = view.get_word()
+        ctx.invoked_with = invoker
+        ctx.command = self.all_commands.get(invoker)
+        return ctx
+
+
+def make_bot(cls):
+    bot = cls({}, 'benchmark', None)
+    bot._connection.user = SimpleNamespace(id=bot_id, name='benchmark')
+    bot.mention_prefixes = (f'<@{bot_id}>', f'<@!{bot_id}>')
+    bot.command_regex = re.compile(fr'(?s)^<@!?{bot_id}>(.*)$')
+    bot.command_dms_regex = re.compile(fr'(?s)^(?:<@!?{bot_id}>)?(.*)$')
+
+    invocations = 0
+
+    async def noop(ctx):
+        nonlocal invocations
+        invocations += 1
+
+    bot.add_command(cmd.Command(noop, name='noop'))
+    return bot, lambda: invocations
+
+
+def make_messages():
+    rng = random.Random(0)
+    guild = SimpleNamespace(id=1)
+    chatter = ['lol', 'did anyone see the match yesterday?', 'https://example.com/some/long/link', '<@98765> look at this', 'ok'] * 4
+
+    messages = []
+    for i in range(num_messages):
+        author = SimpleNamespace(id=rng.randrange(1000), bot=False)
+
+        if rng.random() < command_ratio:
+            content = f'<@!{bot_id}> noop'
+        else:
+            content = rng.choice(chatter)
+
+        messages.append(SimpleNamespace(content=content, guild=guild, author=author, _state=None))
+
+    return messages
+
+
+async def replay(bot, messages):
+    start = time.perf_counter()
+
+    for message in messages:
+        await bot.on_message(message)
+
+    return len(messages) / (time.perf_counter() - start)
+
+
+async def main():
+    messages = make_messages()
+
+    for name, cls in (('old dispatch path', OldGs6Ex), ('pre-filter', Gs6Ex)):
+        bot, invocations = make_bot(cls)
+        rate = await replay(bot, messages)
+        print(f'{name:<18} {rate:>10.0f} messages/s ({invocations()} commands invoked)')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
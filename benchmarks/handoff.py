@@ -0,0 +1,233 @@
+"""Restart time with and without gateway session handoff
+
+Runs a local fake Discord (the REST endpoints the bot uses at startup, plus a gateway that
+supports IDENTIFY, RESUME and member chunking) and starts and stops the bot against it a few
+times, once identifying every time and once resuming the session handed off by the previous run,
+like the restart command does.
+Each start is timed until the bot is ready and its modules are loaded. Chunking the members of
+the guilds is what makes identifying slow, so the fake gateway sends member chunks with a delay.
+Run from the directory containing the gs6ex folder:
+
+    python -m gs6ex.benchmarks.handoff
+"""
+
+import json
+import time
+import asyncio
+import tempfile
+import statistics
+from pathlib import Path
+
+import discord
+from aiohttp import web, WSMsgType
+
+
+runs = 3
+num_guilds = 5
+members_per_guild = 5_000
+chunk_size = 1_000
+# Per chunk, standing in for network and Discord's own latency
+chunk_delay = 0.02
+
+bot_user = {'id': '1000', 'username': 'benchmark', 'discriminator': '0001', 'avatar': None, 'bot': True}
+
+
+def snowflake(n):
+    return str(10_000_000 + n)
+
+
+def json_response(data):
+    # discord.py only parses bodies with exactly this content type, without a charset
+    return web.Response(body=json.dumps(data).encode(), headers={'Content-Type': 'application/json'})
+
+
+def member(user):
+    return {'user': user, 'roles': [], 'joined_at': '2020-01-01T00:00:00+00:00', 'deaf': False, 'mute': False}
+
+
+class FakeDiscord:
+    def __init__(self):
+        self.guild_ids = [snowflake(i) for i in range(num_guilds)]
+
+        # session id -> last sequence number sent
+        self.sessions = {}
+        self.identifies = 0
+        self.resumes = 0
+
+        app = web.Application()
+        app.router.add_get('/api/v7/gateway', self.get_gateway)
+        app.router.add_get('/api/v7/users/@me', self.get_me)
+        app.router.add_get('/api/v7/guilds/{guild_id}', self.get_guild)
+        app.router.add_get('/api/v7/guilds/{guild_id}/channels', self.get_channels)
+        app.router.add_get('/api/v7/guilds/{guild_id}/members/{user_id}', self.get_member)
+        app.router.add_get('/gateway', self.gateway)
+        self.runner = web.AppRunner(app)
+
+    async def start(self):
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.api_base = f'http://127.0.0.1:{port}/api/v7'
+        self.gateway_url = f'ws://127.0.0.1:{port}/gateway'
+
+    async def close(self):
+        await self.runner.cleanup()
+
+    def guild(self, guild_id, full=False):
+        data = {
+            'id': guild_id,
+            'name': f'Guild {guild_id}',
+            'owner_id': snowflake(999_999),
+            'region': 'europe',
+            'roles': [{'id': guild_id, 'name': '@everyone', 'permissions': '104324673', 'position': 0,
+                       'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+            'emojis': [],
+            'features': [],
+            'verification_level': 0,
+        }
+
+        if full:
+            # GUILD_CREATE has more than GET /guilds/{id}
+            data.update(member_count=members_per_guild, large=True, unavailable=False,
+                        members=[member(bot_user)], channels=self.channels(guild_id))
+
+        return data
+
+    def channels(self, guild_id):
+        return [{'id': str(int(guild_id) + 1), 'type': 0, 'name': 'general', 'position': 0,
+                 'permission_overwrites': [], 'guild_id': guild_id}]
+
+    async def get_gateway(self, request):
+        return json_response({'url': self.gateway_url})
+
+    async def get_me(self, request):
+        return json_response(bot_user)
+
+    async def get_guild(self, request):
+        return json_response(self.guild(request.match_info['guild_id']))
+
+    async def get_channels(self, request):
+        return json_response(self.channels(request.match_info['guild_id']))
+
+    async def get_member(self, request):
+        return json_response(member(bot_user))
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+
+        session_id = None
+
+        async def dispatch(event, data):
+            self.sessions[session_id] += 1
+            await ws.send_str(json.dumps({'op': 0, 't': event, 's': self.sessions[session_id], 'd': data}))
+
+        await ws.send_str(json.dumps({'op': 10, 'd': {'heartbeat_interval': 41250}}))
+
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                break
+
+            payload = json.loads(msg.data)
+            op, data = payload['op'], payload['d']
+
+            if op == 1:
+                await ws.send_str(json.dumps({'op': 11}))
+
+            elif op == 2:
+                self.identifies += 1
+                session_id = f'session-{self.identifies}'
+                self.sessions[session_id] = 0
+
+                await dispatch('READY', {
+                    'v': 6, 'user': bot_user, 'session_id': session_id, 'private_channels': [], 'relationships': [],
+                    'guilds': [{'id': guild_id, 'unavailable': True} for guild_id in self.guild_ids]})
+
+                for guild_id in self.guild_ids:
+                    await dispatch('GUILD_CREATE', self.guild(guild_id, full=True))
+
+            elif op == 6:
+                if data['session_id'] not in self.sessions or data['seq'] > self.sessions[data['session_id']]:
+                    await ws.send_str(json.dumps({'op': 9, 'd': False}))
+                    continue
+
+                self.resumes += 1
+                session_id = data['session_id']
+                await dispatch('RESUMED', {})
+
+            elif op == 8:
+                guild_id = str(data['guild_id'])
+                count = -(-members_per_guild // chunk_size)
+
+                for index in range(count):
+                    await asyncio.sleep(chunk_delay)
+                    users = [{'id': snowflake(1_000_000 + index * chunk_size + i), 'username': f'user{i}', 'discriminator': '0001', 'avatar': None}
+                             for i in range(min(chunk_size, members_per_guild - index * chunk_size))]
+                    await dispatch('GUILD_MEMBERS_CHUNK', {'guild_id': guild_id, 'members': [member(u) for u in users],
+                                                           'chunk_index': index, 'chunk_count': count, 'nonce': data.get('nonce')})
+
+        return ws
+
+
+async def start_bot(db_path, hand_off):
+    from .. import Gs6Ex
+
+    bot = Gs6Ex({}, 'benchmark', db_path)
+
+    start = time.perf_counter()
+    task = asyncio.create_task(bot.start('token'))
+
+    # Until core is loaded and persisted, closing earlier would race with the end of the startup
+    while not (bot.is_ready() and 'core' in bot.modules and 'core' in bot.conf.active_modules):
+        if task.done():
+            task.result()
+
+        await asyncio.sleep(0.005)
+
+    elapsed = time.perf_counter() - start
+    result = {
+        'elapsed': elapsed,
+        'guilds': len(bot.guilds),
+        'resumed': int(bot.metrics.counter('gateway_resumed_total').value),
+    }
+
+    bot.hand_off_on_close = hand_off
+    await bot.close()
+    await task
+    return result
+
+
+async def main():
+    fake = FakeDiscord()
+    await fake.start()
+
+    # The bot gets the gateway URL from the REST API, so this points all of it at the fake
+    discord.http.Route.BASE = fake.api_base
+
+    print(f'{num_guilds} guilds with {members_per_guild} members each, {runs} starts each\n')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('identify', 'resume'):
+            db_path = Path(tmp) / mode / 'data.db'
+            db_path.parent.mkdir()
+            hand_off = mode == 'resume'
+
+            # Creates the database, and the session to resume
+            await start_bot(db_path, hand_off)
+
+            results = []
+            for _ in range(runs):
+                results.append(await start_bot(db_path, hand_off))
+
+            times = [r['elapsed'] for r in results]
+            print(f'{mode:<8} median {statistics.median(times) * 1000:>7.0f} ms  min {min(times) * 1000:>7.0f} ms  '
+                  f'{results[-1]["guilds"]} guilds, {sum(r["resumed"] for r in results)}/{runs} resumed')
+
+    print(f'\nGateway: {fake.identifies} identifies, {fake.resumes} resumes')
+    await fake.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
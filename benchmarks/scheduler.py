@@ -0,0 +1,92 @@
+"""Memory per pending job for Module.schedule_task
+
+Compares one asyncio task sleeping per job (how schedule_task used to work)
+against the bot-wide Scheduler, with both ways of passing the job.
+Run from the directory containing the gs6ex folder:
+
+    python -m gs6ex.benchmarks.scheduler
+"""
+
+import time
+import asyncio
+import tracemalloc
+
+from .. import scheduler
+
+
+num_jobs = 20_000
+delay = 3600
+
+
+async def reminder(user_id, text):
+    pass
+
+
+async def task_per_job():
+    async def scheduled_closure(coro):
+        await asyncio.sleep(delay)
+        await coro
+
+    coros = [reminder(i, 'text') for i in range(num_jobs)]
+    tasks = [asyncio.create_task(scheduled_closure(coro)) for coro in coros]
+
+    # Let the tasks start sleeping, which is when their timer handles are created
+    await asyncio.sleep(0)
+
+    def cleanup():
+        for task, coro in zip(tasks, coros):
+            task.cancel()
+            coro.close()
+
+    return cleanup
+
+
+async def scheduler_coroutine_objects():
+    s = scheduler.Scheduler()
+    for i in range(num_jobs):
+        s.schedule_in(delay, reminder(i, 'text'))
+
+    await asyncio.sleep(0)
+    return s.close
+
+
+async def scheduler_coroutine_functions():
+    s = scheduler.Scheduler()
+    for i in range(num_jobs):
+        s.schedule_in(delay, reminder, i, 'text')
+
+    await asyncio.sleep(0)
+    return s.close
+
+
+async def measure(setup):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+
+    cleanup = await setup()
+
+    elapsed = time.perf_counter() - start
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    cleanup()
+    await asyncio.sleep(0)
+
+    return (after - before) / num_jobs, elapsed / num_jobs
+
+
+async def main():
+    print(f'{num_jobs} pending jobs\n')
+
+    for name, setup in (
+        ('task per job', task_per_job),
+        ('scheduler, coroutine objects', scheduler_coroutine_objects),
+        ('scheduler, coroutine functions', scheduler_coroutine_functions),
+    ):
+        per_job, schedule_time = await measure(setup)
+        print(f'{name:<32} {per_job:>7.0f} bytes/job {schedule_time * 1e6:>6.2f} us/job to schedule')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
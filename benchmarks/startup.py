@@ -0,0 +1,89 @@
+"""Startup time with eager and lazy module loading
+
+Starts the bot with every module in the modules folder active, once with lazy_modules off
+and once with it on (after a first start has written the manifest). Every start happens in
+a fresh interpreter, so module imports are cold, and only on_ready is timed.
+Run from the directory containing the gs6ex folder:
+
+    python -m gs6ex.benchmarks.startup
+"""
+
+import sys
+import json
+import time
+import asyncio
+import tempfile
+import statistics
+import subprocess
+from pathlib import Path
+from types import SimpleNamespace
+
+
+runs = 10
+
+
+def module_names():
+    modules_dir = Path(__file__).parent.parent / 'modules'
+    return sorted(path.stem for path in modules_dir.glob('*.py') if 'mod.Module)' in path.read_text())
+
+
+async def start(db_path, setup):
+    from .. import Gs6Ex
+
+    bot = Gs6Ex({}, 'benchmark', db_path)
+    bot._connection.user = SimpleNamespace(id=1234, name='benchmark')
+
+    start = time.perf_counter()
+    await bot.on_ready()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        'elapsed': elapsed,
+        'loaded': len(bot.modules),
+        'deferred': len(bot.lazy.stubs) if bot.lazy else 0,
+        'imported': sum(name.startswith(f'{__package__.rsplit(".", 1)[0]}.modules.') for name in sys.modules),
+    }
+
+    if setup:
+        bot.conf.active_modules.update(module_names())
+        bot.conf.lazy_modules = setup == 'lazy'
+        await bot.conf.commit()
+
+    await bot.close()
+    return result
+
+
+def run_child(db_path, setup=''):
+    output = subprocess.run(
+        [sys.executable, '-m', __spec__.name, 'child', str(db_path), setup],
+        check=True, capture_output=True, text=True).stdout
+
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        print(f'{len(module_names())} modules, {runs} cold starts each\n')
+
+        for mode in ('eager', 'lazy'):
+            db_path = Path(tmp) / mode / 'data.db'
+            db_path.parent.mkdir()
+
+            # Create the database and activate all modules, then start once more to write the manifest
+            run_child(db_path, mode)
+            run_child(db_path)
+
+            results = [run_child(db_path) for _ in range(runs)]
+            times = [r['elapsed'] for r in results]
+            last = results[-1]
+
+            print(f'{mode:<6} median {statistics.median(times) * 1000:>7.1f} ms  min {min(times) * 1000:>7.1f} ms  '
+                  f'{last["loaded"]} loaded, {last["deferred"]} deferred, {last["imported"]} imported')
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['child']:
+        print(json.dumps(asyncio.run(start(sys.argv[2], sys.argv[3]))))
+
+    else:
+        main()
@@ -1,5 +1,4 @@
-import discord.ext.commands as cmd
-import textwrap
+import collections.abc
 
 
 # You can't use escape sequences in f-strings. This makes me sad.
@@ -16,15 +15,106 @@ class Obj(dict):
 # I know there is a pagination function included in Discord, but that had some bugs and
 # strange design choices, so I wrote my own.
 # If all of those are fixed, we should probably use theirs instead.
-def paginate(content, prefix='```py\n', suffix='```', *, max_size=2000, line_length=None):
-    content = str(content)
-    if line_length is None:
-        line_length = max_size - len(prefix) - len(suffix) - 2
-
-    if len(content) + len(prefix) + len(suffix) > max_size:
-        paginator = cmd.Paginator(prefix=prefix, suffix=suffix, max_size=max_size)
-        for line in textwrap.wrap(content, line_length):
-            paginator.add_line(line)
-        return paginator.pages
+
+# Added as the last line of the last page when content is cut off by max_pages
+TRUNCATION_MARKER = '... (output truncated)'
+
+
+class _PageBuilder:
+    # Collects lines into pages of at most max_size characters, prefix and suffix included.
+    # New lines in the content are kept, lines longer than line_length are hard wrapped.
+    def __init__(self, prefix, suffix, max_size, line_length, max_pages):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.max_pages = max_pages
+
+        self.capacity = max_size - len(prefix) - len(suffix)
+        if line_length is None:
+            line_length = self.capacity - 2
+
+        self.line_length = line_length
+
+        self.lines = []
+        self.size = 0
+        self.pages = 0
+        self.truncated = False
+
+    def _render(self):
+        self.pages += 1
+        page = self.prefix + '\n'.join(self.lines) + self.suffix
+        self.lines = []
+        self.size = 0
+        return page
+
+    def _truncate(self):
+        # Cuts off the end of the page to make room for the truncation marker
+        text = '\n'.join(self.lines)[:max(self.capacity - len(TRUNCATION_MARKER) - 1, 0)].removesuffix('\n')
+        self.lines = [text, TRUNCATION_MARKER] if text else [TRUNCATION_MARKER]
+        self.truncated = True
+        return self._render()
+
+    def add(self, text):
+        # Yields the pages completed by adding text. Stops early once the budget is used up.
+        for line in text.split('\n'):
+            for i in range(0, max(len(line), 1), self.line_length):
+                chunk = line[i:i + self.line_length]
+
+                if self.lines and self.size + 1 + len(chunk) > self.capacity:
+                    if self.max_pages is not None and self.pages + 1 >= self.max_pages:
+                        # There is more content than fits into the budget, so we're done
+                        yield self._truncate()
+                        return
+
+                    yield self._render()
+
+                self.size += len(chunk) + (1 if self.lines else 0)
+                self.lines.append(chunk)
+
+    def finish(self):
+        # Yields the last page. There is always at least one, even for empty content.
+        if not self.truncated and (self.lines or not self.pages):
+            yield self._render()
+
+
+def iter_pages(content, prefix='```py\n', suffix='```', *, max_size=2000, line_length=None, max_pages=None):
+    # Yields pages lazily. Iterators (including generators) are consumed one item at a time,
+    # each item starting a new line, and only as far as needed to fill max_pages pages.
+    # Everything else is converted using str().
+    builder = _PageBuilder(prefix, suffix, max_size, line_length, max_pages)
+
+    if isinstance(content, collections.abc.Iterator):
+        items = (str(item) for item in content)
     else:
-        return [prefix + content + suffix]
+        items = (str(content), )
+
+    for text in items:
+        yield from builder.add(text)
+        if builder.truncated:
+            return
+
+    yield from builder.finish()
+
+
+async def apaginate(content, prefix='```py\n', suffix='```', *, max_size=2000, line_length=None, max_pages=None):
+    # Like iter_pages, but also accepts async iterables.
+    if not isinstance(content, collections.abc.AsyncIterable):
+        for page in iter_pages(content, prefix, suffix, max_size=max_size, line_length=line_length, max_pages=max_pages):
+            yield page
+
+        return
+
+    builder = _PageBuilder(prefix, suffix, max_size, line_length, max_pages)
+
+    async for item in content:
+        for page in builder.add(str(item)):
+            yield page
+
+        if builder.truncated:
+            return
+
+    for page in builder.finish():
+        yield page
+
+
+def paginate(content, prefix='```py\n', suffix='```', *, max_size=2000, line_length=None, max_pages=None):
+    return list(iter_pages(content, prefix, suffix, max_size=max_size, line_length=line_length, max_pages=max_pages))
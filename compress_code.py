@@ -1,15 +1,22 @@
 """Compresses a file for use with the execc command"""
 
+import os
 import sys
 import modules.compress as cc
 
+# The file is streamed through the compressor, so memory use doesn't depend on its size
+chunk_size = 64 * 1024
+
 if len(sys.argv) < 2:
     exit(f'Usage: python {sys.argv[0]} <path>')
 
+compressor = cc.Base32768Compressor(cc.choose_codec(os.path.getsize(sys.argv[1])))
+
 with open(sys.argv[1]) as f:
-    source = f.read()
+    while chunk := f.read(chunk_size):
+        sys.stdout.write(compressor.compress(chunk.encode()))
 
-print(cc.base32768_encode_bytes(source.encode()))
+print(compressor.flush())
 
 # print(len(source.encode('utf-16'))//2)
 # print(len(cc.base32768_encode_bytes(source.encode())))
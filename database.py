@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import contextlib
+
+import aiosqlite
+
+from . import metrics
+
+
+log = logging.getLogger('bot')
+
+
+class Database:
+    # One writer connection plus reader connections to the same file.
+    # In WAL mode, readers don't block the writer and the writer doesn't block readers,
+    # so queries from one module don't have to wait behind another module's commit.
+    #
+    # New code should use fetchone/fetchall (served by the readers) and transaction()
+    # (serialized on the writer). execute/executemany/commit are there so code written for a
+    # plain aiosqlite connection keeps working, each call is a transaction of its own.
+
+    default_pragmas = {
+        'journal_mode': 'WAL',
+        # With WAL, NORMAL is still safe against corruption, it just may lose
+        # the last few commits on power loss. It avoids an fsync per commit.
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'foreign_keys': 'ON',
+        'temp_store': 'MEMORY',
+    }
+
+    def __init__(self, path, *, readers=2, pragmas=None, cached_statements=256, registry=None):
+        self.path = path
+        self.num_readers = readers
+        self.pragmas = {**self.default_pragmas, **(pragmas or {})}
+
+        # sqlite3 keeps an LRU cache of prepared statements per connection, keyed by the SQL text.
+        # Using constant SQL strings with ? parameters means statements are only prepared once.
+        self.cached_statements = cached_statements
+
+        self._writer = None
+        self._write_lock = asyncio.Lock()
+        self._readers = []
+        self._next_reader = 0
+
+        # Timings go into a throwaway registry if we weren't given one
+        registry = registry if registry is not None else metrics.Metrics()
+        self._query_time = registry.histogram('db_query_seconds', 'Time to run a read query')
+        self._transaction_time = registry.histogram('db_transaction_seconds', 'Time from requesting the writer to the end of the commit')
+        self._commit_time = registry.histogram('db_commit_seconds', 'Time to commit')
+
+    async def _connect(self, *, read_only=False):
+        conn = await aiosqlite.connect(self.path, cached_statements=self.cached_statements)
+
+        for name, value in self.pragmas.items():
+            await conn.execute(f'PRAGMA {name} = {value};')
+
+        if read_only:
+            await conn.execute('PRAGMA query_only = ON;')
+
+        return conn
+
+    async def connect(self):
+        # The writer has to go first, since it switches the file to WAL mode
+        self._writer = await self._connect()
+
+        for _ in range(self.num_readers):
+            self._readers.append(await self._connect(read_only=True))
+
+        log.info(f'Opened database {str(self.path)!r} with {self.num_readers} readers')
+        return self
+
+    async def close(self):
+        for reader in self._readers:
+            await reader.close()
+
+        self._readers.clear()
+
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+
+    def _reader(self):
+        # Readers are shared round-robin. aiosqlite runs the queries of each one after another on its own thread.
+        reader = self._readers[self._next_reader]
+        self._next_reader = (self._next_reader + 1) % len(self._readers)
+        return reader
+
+    async def fetchone(self, sql, parameters=()):
+        with metrics.Timer(self._query_time):
+            async with self._reader().execute(sql, parameters) as cursor:
+                return await cursor.fetchone()
+
+    async def fetchall(self, sql, parameters=()):
+        with metrics.Timer(self._query_time):
+            async with self._reader().execute(sql, parameters) as cursor:
+                return await cursor.fetchall()
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        # Yields the writer connection. Everything executed in the block is committed
+        # when it exits normally, and rolled back if it raises.
+        with metrics.Timer(self._transaction_time):
+            async with self._write_lock:
+                try:
+                    yield self._writer
+
+                except BaseException:
+                    await self._writer.rollback()
+                    raise
+
+                else:
+                    with metrics.Timer(self._commit_time):
+                        await self._writer.commit()
+
+    # Plain aiosqlite interface, on the writer. Every call commits, serialized with and timed like transaction() blocks.
+
+    async def execute(self, sql, parameters=None):
+        async with self.transaction() as tx:
+            return await tx.execute(sql, parameters)
+
+    async def executemany(self, sql, parameters):
+        async with self.transaction() as tx:
+            return await tx.executemany(sql, parameters)
+
+    async def commit(self):
+        # Everything is committed already
+        async with self.transaction():
+            pass
+
+    async def rollback(self):
+        async with self._write_lock:
+            await self._writer.rollback()
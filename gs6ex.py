@@ -1,15 +1,29 @@
+import copy
+import math
+import time
 import typing
 import asyncio
-import re
+import pickle
 from datetime import datetime as dt, timezone as tz
 import logging
+from pathlib import Path
 
-import aiosqlite
+import aiohttp
 import discord
 import discord.ext.commands as cmd
+from discord.backoff import ExponentialBackoff
+from discord.gateway import DiscordWebSocket, ReconnectWebSocket
 from discord.ext.commands.view import StringView
 
 from . import module
+from . import database
+from . import scheduler
+from . import ratelimit
+from . import outbox
+from . import lazy
+from . import logs
+from . import metrics
+from . import session
 
 
 log = logging.getLogger('bot')
@@ -20,6 +34,10 @@ class Gs6Ex(cmd.Bot):
     class Config(module.Config):
         active_modules: set[str] = set()
         superusers: set[int] = set()
+        # Only import modules when one of their commands is first used, see lazy.py
+        lazy_modules: bool = False
+        # Logger name -> level, changed with the loglevel command
+        log_levels: dict[str, str] = {}
 
     def __init__(self, credentials, profile_name, db_path):
         intents = discord.Intents.default()
@@ -35,89 +53,465 @@ class Gs6Ex(cmd.Bot):
         self.db_path = db_path
         
         self.db = None
+        self.config_store = None
         self.conf = None
         self.credentials = credentials
 
+        # Where close() saves the session for the next process, and the session we took over until it is resumed
+        self.session_path = Path(db_path).parent / 'session.json' if db_path is not None else None
+        self._handoff = None
+        self._handing_off = False
+        self._chunk_task = None
+        # Set by the restart command, only then does close() hand the session over
+        self.hand_off_on_close = False
+
         self.first_ready = None
         self.last_ready = None
         self.last_resume = None
 
-        self.command_regex = None
-        self.command_dms_regex = None
+        # The strings a mention of the bot can start with, set in on_ready
+        self.mention_prefixes = ()
 
         self.modules = {}
 
+        # Incremented whenever the set of commands changes, so things derived from it can be cached
+        self.commands_version = 0
+
+        self.scheduler = scheduler.Scheduler()
+        self.job_store = None
+        self.rate_limiter = ratelimit.RateLimiter()
+        self.outbox = outbox.Outbox()
+        self.lazy = None
+
+        self.metrics = metrics.Metrics()
+        self._ready_count = self.metrics.counter('gateway_ready_total', 'READY events, i.e. new gateway sessions')
+        self._resumed_count = self.metrics.counter('gateway_resumed_total', 'Gateway sessions resumed after a reconnect')
+        self._disconnect_count = self.metrics.counter('gateway_disconnects_total', 'Lost gateway connections')
+        self.metrics.add_collector(self._collect_metrics)
+
     async def on_ready(self):
         log.info(f'Ready with Username {self.user.name!r}, ID {self.user.id!r}')
 
+        # If we tried to take over a session, it was rejected and we identified instead
+        self._handoff = None
+
         now = dt.now(tz.utc)
         self.last_ready = now
+        self._ready_count.inc()
+
+        await self.start_up(now)
 
-        self.command_regex = re.compile(fr'(?s)^<@!?{self.user.id}>(.*)$')
-        self.command_dms_regex = re.compile(fr'(?s)^(?:<@!?{self.user.id}>)?(.*)$')
+    async def start_up(self, now):
+        # Runs on every new session, whether it was identified or taken over from the previous process
+        self.mention_prefixes = (f'<@{self.user.id}>', f'<@!{self.user.id}>')
 
         if self.first_ready is None:
-            self.db = await aiosqlite.connect(self.db_path)
-
-            async with self.db.execute('PRAGMA user_version;') as cursor:
-                user_version, = await cursor.fetchone()
-                log.info(f'Schema version {user_version}')
-                if user_version == 0:
-                    log.warning(f'Initializing database...')
-                    await self.db.execute('''
-                        CREATE TABLE IF NOT EXISTS config (
-                            name TEXT PRIMARY KEY,
-                            data BLOB NOT NULL
-                        );''')
-                    await self.db.execute('PRAGMA user_version = 1;')
-                    await self.db.commit()
-
-            self.conf = self.Config(self.db, 'gs6ex')
+            self.metrics.start(Path(self.db_path).parent / 'metrics.prom')
+            self.db = await database.Database(self.db_path, registry=self.metrics).connect()
+            await self.migrate_db()
+
+            self.config_store = module.ConfigStore(self.db)
+            await self.config_store.preload()
+
+            self.job_store = scheduler.JobStore(self)
+            await self.job_store.preload()
+
+            self.conf = self.Config(self.config_store, 'gs6ex')
             await self.conf.load()
-            
+
+            try:
+                logs.apply_levels(self.conf.log_levels)
+            except ValueError:
+                log.error('Invalid log level in config', exc_info=True)
+
             self.first_ready = now
             # The core module should always be loaded, so we can use eval to repair misconfigurations
-            for mod_name in {'core', *self.conf.active_modules}:
-                try:
-                    await self.load_module(mod_name)
-                except:
-                    log.error(f'Error loading module {mod_name}', exc_info=True)
+            names = {'core', *self.conf.active_modules}
+
+            if self.conf.lazy_modules:
+                self.lazy = lazy.LazyModules(self, Path(self.db_path).parent / 'modules.json')
+                self.lazy.read()
+                names = self.lazy.add_stubs(names)
+
+            await self.load_modules(names)
+
+            if self.lazy is not None:
+                self.lazy.save()
+
+    async def migrate_db(self):
+        user_version, = await self.db.fetchone('PRAGMA user_version;')
+        log.info(f'Schema version {user_version}')
+
+        if user_version < 1:
+            log.warning(f'Initializing database...')
+            async with self.db.transaction() as tx:
+                await tx.execute('''
+                    CREATE TABLE IF NOT EXISTS config (
+                        name TEXT PRIMARY KEY,
+                        data BLOB NOT NULL
+                    );''')
+                await tx.execute('PRAGMA user_version = 1;')
+
+        if user_version < 2:
+            log.warning(f'Migrating config to per-key storage...')
+            async with self.db.transaction() as tx:
+                await tx.execute('''
+                    CREATE TABLE IF NOT EXISTS config_items (
+                        name TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        data BLOB NOT NULL,
+                        PRIMARY KEY (name, key)
+                    );''')
+
+                async with tx.execute('SELECT name, data FROM config;') as cursor:
+                    configs = await cursor.fetchall()
+
+                await tx.executemany(
+                    'INSERT OR REPLACE INTO config_items (name, key, data) VALUES (?, ?, ?);',
+                    [(name, key, pickle.dumps(value)) for name, data in configs for key, value in pickle.loads(data).items()])
+                await tx.execute('DROP TABLE config;')
+                await tx.execute('PRAGMA user_version = 2;')
+
+        if user_version < 3:
+            log.warning(f'Creating scheduled job table...')
+            async with self.db.transaction() as tx:
+                await tx.execute('''
+                    CREATE TABLE IF NOT EXISTS scheduled_jobs (
+                        id INTEGER PRIMARY KEY,
+                        module TEXT NOT NULL,
+                        handler TEXT NOT NULL,
+                        args BLOB NOT NULL,
+                        due REAL NOT NULL
+                    );''')
+                await tx.execute('CREATE INDEX IF NOT EXISTS scheduled_jobs_module_due ON scheduled_jobs (module, due);')
+                await tx.execute('PRAGMA user_version = 3;')
+
+        if user_version < 4:
+            log.warning(f'Creating snippet table...')
+            async with self.db.transaction() as tx:
+                # code is the marshalled code object, which is only valid for the python version in cache_tag
+                await tx.execute('''
+                    CREATE TABLE IF NOT EXISTS snippets (
+                        name TEXT PRIMARY KEY,
+                        hash BLOB NOT NULL,
+                        payload TEXT NOT NULL,
+                        code BLOB NOT NULL,
+                        cache_tag TEXT NOT NULL
+                    );''')
+                await tx.execute('PRAGMA user_version = 4;')
+
+        if user_version < 5:
+            log.warning(f'Storing snippets by the hash of their payload...')
+            async with self.db.transaction() as tx:
+                # Snippets with the same payload share one row of snippet_payloads, which is deleted with the last of them
+                await tx.execute('ALTER TABLE snippets RENAME TO snippets_v4;')
+                await tx.execute('''
+                    CREATE TABLE snippet_payloads (
+                        hash BLOB PRIMARY KEY,
+                        payload TEXT NOT NULL,
+                        code BLOB NOT NULL,
+                        cache_tag TEXT NOT NULL
+                    );''')
+                await tx.execute('''
+                    CREATE TABLE snippets (
+                        name TEXT PRIMARY KEY,
+                        hash BLOB NOT NULL REFERENCES snippet_payloads (hash)
+                    );''')
+                await tx.execute('CREATE INDEX snippets_hash ON snippets (hash);')
+                await tx.execute('INSERT OR IGNORE INTO snippet_payloads (hash, payload, code, cache_tag) SELECT hash, payload, code, cache_tag FROM snippets_v4;')
+                await tx.execute('INSERT INTO snippets (name, hash) SELECT name, hash FROM snippets_v4;')
+                await tx.execute('DROP TABLE snippets_v4;')
+                await tx.execute('PRAGMA user_version = 5;')
 
     async def on_resumed(self):
         log.warning(f'Resumed')
-        self.last_resume = dt.now(tz.utc)
+        now = dt.now(tz.utc)
+        self.last_resume = now
+        self._resumed_count.inc()
+
+        if self._handoff is not None:
+            # There won't be a READY, so we have to do what discord.py and on_ready would have done
+            log.info(f'Took over the previous session with {len(self.guilds)} guilds')
+            self._handoff = None
+            self._ready.set()
+            self._chunk_task = asyncio.create_task(session.chunk_guilds(self))
+            await self.start_up(now)
+
+    async def connect(self, *, reconnect=True):
+        # Resumes the session saved by the previous process first if there is one (see session.py),
+        # everything else is discord.py's connection loop.
+        saved = session.take(self.session_path) if self.session_path is not None else None
+        if saved is not None:
+            await self.resume_handoff(saved, reconnect=reconnect)
+
+        if not self.is_closed():
+            await super().connect(reconnect=reconnect)
+
+    async def resume_handoff(self, saved, *, reconnect=True):
+        # Runs the connections of a session taken over from the previous process for as long as the session lasts.
+        # Like in discord.py's loop, a lost connection is resumed with the session id and sequence of the last one.
+        # Once the session is invalidated (or can't be resumed in the first place), this returns, and discord.py
+        # identifies a new session.
+        try:
+            await session.rebuild_cache(self, saved)
+
+        except (discord.HTTPException, aiohttp.ClientError, asyncio.TimeoutError):
+            log.warning('Could not rebuild the cache, identifying instead of resuming', exc_info=True)
+            return
+
+        self._handoff = saved
+        params = {'gateway': saved['gateway'], 'session': saved['session_id'], 'sequence': saved['sequence']}
+        backoff = ExponentialBackoff()
+
+        while not self.is_closed():
+            try:
+                coro = DiscordWebSocket.from_client(self, shard_id=self.shard_id, resume=True, **params)
+                self.ws = await asyncio.wait_for(coro, timeout=60.0)
+                while True:
+                    await self.ws.poll_event()
+
+            except ReconnectWebSocket as e:
+                self.dispatch('disconnect')
+                if not e.resume:
+                    break
+
+            except (OSError, discord.HTTPException, discord.GatewayNotFound, discord.ConnectionClosed, aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                self.dispatch('disconnect')
+                if not reconnect:
+                    await self.close()
+                    raise
+
+                if self.is_closed():
+                    break
+
+                # discord.py only raises this for close codes it can't resume after, it deals with them when identifying
+                if isinstance(exc, discord.ConnectionClosed):
+                    break
+
+                retry = backoff.delay()
+                log.warning(f'Lost the connection of the session taken over, resuming in {retry:.2f} s', exc_info=True)
+                await asyncio.sleep(retry)
+
+            # The next connection resumes where the last one left off
+            if self.ws is not None and self.ws.session_id is not None:
+                params.update(session=self.ws.session_id, sequence=self.ws.sequence)
+
+        self._handoff = None
+
+    def is_closed(self):
+        # Once the session is handed off, discord.py must not reconnect and resume it in this process
+        return self._handing_off or super().is_closed()
+
+    async def hand_off_session(self):
+        # Closes the connection without ending the session, and saves it for the next process
+        ws = self.ws
+        if ws is None or not ws.open or not ws.session_id or self._handoff is not None or self.session_path is None:
+            return
+
+        self._handing_off = True
+
+        # Closing with 1000 or 1001 would end the session, any other code keeps it resumable
+        await ws.close(code=4000)
+
+        try:
+            session.save(self.session_path, ws, (guild.id for guild in self.guilds))
+            log.info(f'Saved session for handoff at sequence {ws.sequence}')
+
+        except OSError:
+            log.warning('Could not save the session', exc_info=True)
+
+    async def on_disconnect(self):
+        self._disconnect_count.inc()
+
+    def _collect_metrics(self):
+        gauge = self.metrics.gauge
+        gauge('modules_loaded', 'Loaded modules').set(len(self.modules))
+        gauge('scheduler_pending_jobs', 'Jobs on the in-memory scheduler').set(len(self.scheduler))
+        if not math.isnan(self.latency):
+            gauge('latency_seconds', 'Gateway heartbeat latency').set(self.latency)
+
+        for name, value in self.outbox.stats().items():
+            gauge(f'outbox_{name}', 'Outbox statistics, see Outbox.stats').set(value)
+
+        for name, count in self.rate_limiter.rejected.items():
+            gauge('commands_rate_limited', 'Invocations rejected by rate or concurrency limits', command=name).set(count)
 
     async def close(self):
         log.info('Closing...')
-        for mod in self.modules.copy():
+        if self.hand_off_on_close:
+            # First, so events that happen while we shut down are replayed to the next process
+            await self.hand_off_session()
+
+        if self._chunk_task is not None:
+            self._chunk_task.cancel()
+
+        for mod in reversed(self.dependency_order()):
             await self.unload_module(mod, persistent=False)
 
+        self.scheduler.close()
+        await self.outbox.flush()
+
+        if self.first_ready is not None:
+            try:
+                self.metrics.dump(Path(self.db_path).parent / 'metrics.prom')
+            except OSError:
+                log.warning('Could not write metrics', exc_info=True)
+
+        self.metrics.close()
+
+        if self.config_store:
+            await self.config_store.close()
+
         if self.db:
             await self.db.close()
 
         await super().close()
 
+    async def load_modules(self, names, persistent=True):
+        # Loads (or reloads) the given modules, plus the dependencies that aren't loaded yet.
+        # Every module is loaded as soon as its dependencies are, so independent modules load concurrently.
+        # A module that fails to load only takes the modules depending on it down with it.
+        # Returns a dict of module name -> exception for the modules that failed to load.
+        start = time.perf_counter()
+        classes = {}
+        errors = {}
+
+        to_resolve = list(names)
+        while to_resolve:
+            while to_resolve:
+                name = to_resolve.pop()
+                if name in classes or name in errors:
+                    continue
+
+                try:
+                    classes[name] = module.get_module_class(name)
+
+                except Exception as e:
+                    log.error(f'Error importing module {name}', exc_info=True)
+                    errors[name] = e
+                    continue
+
+                to_resolve.extend(dep for dep in classes[name].dependencies if dep not in self.modules)
+
+            # Importing may have reloaded code used by other loaded modules (a shared helper, for example).
+            # Those have to be reloaded as well, or they keep running the old code.
+            to_resolve.extend(n for n, instance in self.modules.items() if n not in classes and n not in errors and module.is_stale(instance))
+
+        # Sort topologically, so every module comes after its dependencies
+        order = []
+        visited = set()
+
+        def visit(name, path):
+            if name in visited or name in errors:
+                return
+
+            if name in path:
+                cycle = path[path.index(name):] + (name, )
+                error = RuntimeError(f'Dependency cycle: {" -> ".join(cycle)}')
+                log.error(f'Error loading module {name}: {error}')
+
+                for cycle_name in cycle:
+                    errors[cycle_name] = error
+
+                return
+
+            for dep in classes[name].dependencies:
+                if dep in classes:
+                    visit(dep, path + (name, ))
+
+            visited.add(name)
+            if name not in errors:
+                order.append(name)
+
+        for name in classes:
+            visit(name, ())
+
+        tasks = {}
+
+        async def load(name):
+            C = classes[name]
+            await asyncio.gather(*(tasks[dep] for dep in C.dependencies if dep in tasks))
+
+            try:
+                missing = [dep for dep in C.dependencies if dep not in self.modules]
+                if missing:
+                    raise RuntimeError(f'Dependencies not loaded: {", ".join(missing)}')
+
+                load_start = time.perf_counter()
+                await self._load_module_class(name, C)
+                log.info(f'Loaded module {name} in {(time.perf_counter() - load_start) * 1000:.0f} ms')
+
+            except Exception as e:
+                log.error(f'Error loading module {name}', exc_info=True)
+                errors[name] = e
+
+        for name in order:
+            tasks[name] = asyncio.create_task(load(name))
+
+        await asyncio.gather(*tasks.values())
+        loaded = [name for name in order if name not in errors]
+        log.info(f'Loaded {len(loaded)} modules in {(time.perf_counter() - start) * 1000:.0f} ms' + (f', {len(errors)} failed' if errors else ''))
+
+        if persistent:
+            # Dependencies that were loaded implicitly aren't persisted, they'll be loaded again with their dependents
+            self.conf.active_modules.update(name for name in names if name in loaded)
+            await self.conf.commit()
+
+        return errors
+
     async def load_module(self, name, persistent=True):
+        # Other modules that failed (stale ones that were reloaded along with it) are only logged
+        errors = await self.load_modules((name, ), persistent)
+        if name in errors:
+            raise errors[name]
+
+    async def _load_module_class(self, name, C):
         if name in self.modules:
             await self.unload_module(name, persistent=False)
-        
-        C = module.get_module_class(name)
 
         instance = C(self)
         await instance._on_load()
+
+        if self.lazy is not None:
+            self.lazy.remove_stubs(name)
+
         self.modules[name] = instance
         self.add_cog(instance)
+        self.commands_version += 1
 
-        if persistent:
-            self.conf.active_modules.add(name)
-            await self.conf.commit()
+        if self.lazy is not None:
+            self.lazy.loaded(name, instance)
+
+    def dependency_order(self):
+        # The loaded modules, each after its dependencies. Not the order of self.modules, a reloaded module moves to its end.
+        order = []
+        visited = set()
+
+        def visit(name):
+            if name in visited or name not in self.modules:
+                return
+
+            visited.add(name)
+            for dep in self.modules[name].dependencies:
+                visit(dep)
+
+            order.append(name)
+
+        for name in self.modules:
+            visit(name)
+
+        return order
 
     async def unload_module(self, name, persistent=True):
         if name in self.modules:
             self.remove_cog(name)
             await self.modules[name]._on_unload()
             del self.modules[name]
-        
+            self.commands_version += 1
+
+        if self.lazy is not None:
+            self.lazy.remove_stubs(name)
+
         if persistent:
             self.conf.active_modules.discard(name)
             await self.conf.commit()
@@ -125,6 +519,98 @@ class Gs6Ex(cmd.Bot):
     async def is_superuser(self, user):
         return user.id in self.conf.superusers or await self.is_owner(user)
 
+    async def on_message(self, message):
+        # Almost none of the messages we see in guilds are commands, and those have to start with a mention.
+        # Rejecting everything else here is much cheaper than building a context for each of them.
+        if message.guild is not None and not message.content.startswith(self.mention_prefixes):
+            return
+
+        await self.process_commands(message)
+
+    async def invoke(self, ctx):
+        # The command's checks come first, then the rate and concurrency limits, and only then the argument
+        # conversion and the command itself. So only invocations that pass the checks use up the limits,
+        # and spamming a command costs us nothing but the checks and a lookup.
+        if ctx.command is None:
+            return await super().invoke(ctx)
+
+        if lazy.is_stub(ctx.command):
+            # Stubs have the checks of their command, so only users who could use it make us load the module
+            try:
+                allowed = await ctx.command.can_run(ctx)
+
+            except cmd.CommandError:
+                allowed = False
+
+            if not allowed:
+                log.debug(f'{ctx.author} may not use {ctx.command.name!r}, not loading its module')
+                return
+
+            try:
+                await self.lazy.resolve(ctx.command)
+
+            except Exception:
+                # Already logged by load_modules
+                return
+
+            ctx.command = self.all_commands.get(ctx.invoked_with)
+            if ctx.command is None:
+                return
+
+        name = ctx.command.qualified_name
+        start = time.perf_counter()
+
+        # discord.py runs the checks again when it prepares the command, ours are cheap (is_owner is cached)
+        commands = self._invoked_commands(ctx)
+        for command in commands:
+            try:
+                if not await command.can_run(ctx):
+                    raise cmd.CheckFailure(f'The check functions for command {command.qualified_name} failed.')
+
+            except cmd.CommandError as e:
+                # Reported like discord.py does for checks that fail while preparing
+                await command.dispatch_error(ctx, e)
+                self._observe_command(ctx, name, start)
+                return
+
+        # Limits are those of the command that runs, a group's aren't a subcommand's
+        release = self.rate_limiter.acquire(ctx, commands[-1])
+        if release is None:
+            log.debug(f'Rate limited {name!r} for {ctx.author} in {ctx.channel}')
+            return
+
+        try:
+            await super().invoke(ctx)
+
+        finally:
+            release()
+            self._observe_command(ctx, name, start)
+
+    def _invoked_commands(self, ctx):
+        # The command that was invoked, followed by the subcommands the message names, found like Group.invoke
+        # does without consuming the message. Groups with arguments of their own parse those first, so the
+        # search stops at them.
+        commands = [ctx.command]
+        if ctx.view is None:
+            return commands
+
+        view = copy.copy(ctx.view)
+        while isinstance(commands[-1], cmd.Group) and not commands[-1].clean_params:
+            view.skip_ws()
+            subcommand = commands[-1].all_commands.get(view.get_word())
+            if subcommand is None:
+                break
+
+            commands.append(subcommand)
+
+        return commands
+
+    def _observe_command(self, ctx, name, start):
+        # discord.py handles command errors itself, it just marks the context as failed
+        outcome = 'error' if ctx.command_failed else 'ok'
+        self.metrics.histogram('command_seconds', 'Command run time, including checks and argument conversion', command=name).observe(time.perf_counter() - start)
+        self.metrics.counter('commands_total', 'Command invocations', command=name, outcome=outcome).inc()
+
     async def get_context(self, message, *, cls=cmd.Context):
         # This function is called internally by discord.py.
         # We have to fiddle with it because we are using a dynamic prefix (our mention string),
@@ -136,16 +622,22 @@ class Gs6Ex(cmd.Bot):
         # to periodically check the get_context method on the base class and
         # port over any changes that happened there. ~hmry (2019-08-14, 02:25)
 
-        if self.command_regex is None:
+        if not self.mention_prefixes:
             return cls(prefix=None, view=None, bot=self, message=message)
 
-        cmd_regex = self.command_dms_regex if message.guild is None else self.command_regex
-        match = cmd_regex.match(message.content)
+        content = message.content
 
-        if not match:
-            return cls(prefix=None, view=None, bot=self, message=message)
+        for prefix in self.mention_prefixes:
+            if content.startswith(prefix):
+                content = content[len(prefix):]
+                break
+
+        else:
+            # The mention is only optional in DMs
+            if message.guild is not None:
+                return cls(prefix=None, view=None, bot=self, message=message)
 
-        view = StringView(match.group(1).strip())
+        view = StringView(content.strip())
         ctx = cls(prefix=None, view=view, bot=self, message=message)
 
         if self._skip_check(message.author.id, self.user.id):
@@ -0,0 +1,195 @@
+import json
+import asyncio
+import logging
+import importlib.util
+from pathlib import Path
+
+import discord.ext.commands as cmd
+
+from . import module
+
+
+log = logging.getLogger('bot')
+
+
+# Lazy module loading, enabled with the lazy_modules bot config option.
+#
+# For every module we load, we remember its top level commands in a manifest file, along with the
+# modification time of its source. On the next start, modules whose source hasn't changed since then
+# aren't imported at all. Instead, stub commands with the same name, aliases, usage, description and checks
+# are registered (so they show up in help), and the module is imported and loaded when one of them is
+# first invoked by someone who passes the checks (see Gs6Ex.invoke).
+#
+# Modules that have to run before they are invoked are always loaded eagerly:
+# core, modules with event listeners or an on_load hook, and modules with persistent scheduled jobs.
+# So are modules with checks stubs can't recreate: a stub must never let more users through than its command.
+
+# The checks stubs can have, by name
+stub_checks = {
+    'is_owner': module.is_owner,
+    'is_superuser': module.is_superuser,
+}
+
+
+def source_mtime(name):
+    # Modification time of a module's source, found without importing it
+    spec = importlib.util.find_spec(f'{module.parent_module}.modules.{name}')
+    if spec is None or spec.origin is None:
+        return None
+
+    if spec.submodule_search_locations:
+        return max((path.stat().st_mtime_ns for location in spec.submodule_search_locations for path in Path(location).rglob('*.py')), default=None)
+
+    return Path(spec.origin).stat().st_mtime_ns
+
+
+def check_name(check):
+    # The name of a check made by one of the stub_checks, or None if it's another one
+    name = check.__qualname__.split('.', maxsplit=1)[0]
+    if check.__module__ == module.__name__ and name in stub_checks:
+        return name
+
+    return None
+
+
+def describe(instance):
+    # The commands of a loaded module, or None if it can't be loaded lazily
+    if instance.get_listeners() or hasattr(instance, 'on_load') or type(instance).cog_check is not cmd.Cog.cog_check:
+        return None
+
+    commands = []
+    for c in instance.get_commands():
+        checks = [check_name(check) for check in c.checks]
+        if None in checks:
+            return None
+
+        commands.append({
+            'name': c.name,
+            'aliases': list(c.aliases),
+            'usage': c.usage,
+            'description': c.description,
+            'hidden': c.hidden,
+            'checks': checks,
+        })
+
+    return commands
+
+
+def make_stub(name, info):
+    checks = [stub_checks[check]().predicate for check in info['checks']]
+    stub = cmd.Command(_stub_callback, **{**info, 'checks': checks})
+    stub.__gs6ex_lazy_module__ = name
+    return stub
+
+
+async def _stub_callback(ctx):
+    # Stubs are replaced by the real command before they are invoked
+    raise RuntimeError(f'Stub command {ctx.command.name!r} was invoked directly')
+
+
+def is_stub(command):
+    return hasattr(command, '__gs6ex_lazy_module__')
+
+
+class LazyModules:
+    def __init__(self, bot, path):
+        self.bot = bot
+        self.path = path
+
+        # module name -> {'mtime': source mtime, 'commands': describe(instance)}
+        self.manifest = {}
+
+        # module name -> stub commands
+        self.stubs = {}
+
+        # module name -> task loading it, while it's being loaded
+        self._loading = {}
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                self.manifest = json.load(f)
+
+        except FileNotFoundError:
+            self.manifest = {}
+
+        except (OSError, ValueError):
+            log.warning(f'Could not read module manifest {str(self.path)!r}, loading all modules eagerly', exc_info=True)
+            self.manifest = {}
+
+    def save(self):
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self.manifest, f, indent=1)
+
+        except OSError:
+            log.warning(f'Could not save module manifest {str(self.path)!r}', exc_info=True)
+
+    def add_stubs(self, names):
+        # Registers stubs for the modules that can be loaded lazily.
+        # Returns the names of the other modules, which have to be loaded now.
+        eager = set()
+
+        for name in names:
+            entry = self.manifest.get(name)
+
+            # Manifests written before stubs had checks don't list them, those modules are described again
+            if (name == 'core' or entry is None or entry['commands'] is None
+                    or any('checks' not in info or not set(info['checks']) <= stub_checks.keys() for info in entry['commands'])
+                    or self.bot.job_store.has_jobs(name) or entry['mtime'] != source_mtime(name)):
+                eager.add(name)
+                continue
+
+            stubs = []
+            for info in entry['commands']:
+                stub = make_stub(name, info)
+
+                # Commands of modules loaded in the meantime take precedence
+                if stub.name in self.bot.all_commands:
+                    continue
+
+                self.bot.add_command(stub)
+                stubs.append(stub)
+
+            self.stubs[name] = stubs
+
+        if self.stubs:
+            self.bot.commands_version += 1
+            log.info(f'Deferred loading {len(self.stubs)} modules: {", ".join(sorted(self.stubs))}')
+
+        return eager
+
+    def remove_stubs(self, name):
+        stubs = self.stubs.pop(name, None)
+        if stubs is None:
+            return
+
+        for stub in stubs:
+            if self.bot.all_commands.get(stub.name) is stub:
+                self.bot.remove_command(stub.name)
+
+        self.bot.commands_version += 1
+
+    def loaded(self, name, instance):
+        # Called when a module was loaded, lazily or not
+        self.remove_stubs(name)
+        self.manifest[name] = {'mtime': source_mtime(name), 'commands': describe(instance)}
+
+    async def resolve(self, stub):
+        # Loads the module a stub belongs to. Concurrent invocations wait for the same load.
+        name = stub.__gs6ex_lazy_module__
+
+        task = self._loading.get(name)
+        if task is None:
+            task = self._loading[name] = asyncio.create_task(self._load(name))
+
+        await asyncio.shield(task)
+
+    async def _load(self, name):
+        try:
+            log.info(f'Loading module {name} on first use')
+            await self.bot.load_module(name, persistent=False)
+            self.save()
+
+        finally:
+            del self._loading[name]
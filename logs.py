@@ -0,0 +1,136 @@
+import sys
+import copy
+import queue
+import logging
+import logging.handlers
+
+
+# Log records are formatted and written by a background thread, so logging never blocks the event loop
+# on the output (which is usually a pipe to journald). Only their message is put together where they are logged. If the thread can't keep up, the queue fills up
+# and further records are dropped (and counted) rather than making the logging call wait.
+
+log_format = '[%(asctime)s] (%(levelname)s) %(name)s: %(message)s'
+
+# Logger name -> the level LogPipeline set, which resetting a level goes back to
+default_levels = {}
+
+# Tracebacks don't depend on the format
+_exc_formatter = logging.Formatter()
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The arguments may be objects of the thread that logged the record (tasks or discord models on the event loop),
+        # so the message and the traceback are made into text here. The listener is in the same process, so unlike the
+        # stdlib version, this doesn't format the whole record. That's left to the listener thread.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _exc_formatter.formatException(record.exc_info)
+
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+
+        except queue.Full:
+            self.dropped += 1
+
+
+class DropReportingListener(logging.handlers.QueueListener):
+    # Logs a warning after records were dropped, as soon as there is room again
+    def __init__(self, queue, *handlers, queue_handler):
+        super().__init__(queue, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self.reported = 0
+
+    def handle(self, record):
+        dropped = self.queue_handler.dropped
+        if dropped != self.reported:
+            super().handle(logging.makeLogRecord({
+                'name': 'bot',
+                'levelno': logging.WARNING,
+                'levelname': 'WARNING',
+                'msg': f'Log queue was full, dropped {dropped - self.reported} records ({dropped} in total)',
+            }))
+            self.reported = dropped
+
+        super().handle(record)
+
+
+class LogPipeline:
+    def __init__(self, levels, *, stream=sys.stdout, max_queued=10_000):
+        # levels: logger name -> level, for the loggers that should be output
+        self.queue = queue.Queue(max_queued)
+        self.handler = BoundedQueueHandler(self.queue)
+
+        output = logging.StreamHandler(stream)
+        output.setFormatter(logging.Formatter(log_format))
+        self.listener = DropReportingListener(self.queue, output, queue_handler=self.handler)
+
+        self.loggers = []
+        for name, level in levels.items():
+            logger = logging.getLogger(name)
+            logger.setLevel(level)
+            logger.addHandler(self.handler)
+            default_levels[name] = level
+            self.loggers.append(logger)
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def __enter__(self):
+        self.listener.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        # Writes out everything still in the queue
+        self.listener.stop()
+
+        for logger in self.loggers:
+            logger.removeHandler(self.handler)
+
+
+def parse_level(level):
+    # Accepts level names (case insensitive) and numbers
+    if isinstance(level, int) or level.isdigit():
+        return int(level)
+
+    number = logging.getLevelName(level.upper())
+    if not isinstance(number, int):
+        raise ValueError(f'Unknown log level {level!r}')
+
+    return number
+
+
+def apply_levels(levels):
+    # levels: logger name -> level name or number
+    # All levels are parsed before any is set, so an invalid one leaves every logger as it was
+    parsed = {name: parse_level(level) for name, level in levels.items()}
+
+    for name, level in parsed.items():
+        logging.getLogger(name).setLevel(level)
+
+
+def reset_level(name):
+    logging.getLogger(name).setLevel(default_levels.get(name, logging.NOTSET))
+
+
+def dropped_records():
+    # Number of records dropped by the pipeline the bot logger writes to, or None if there is none
+    for handler in logging.getLogger('bot').handlers:
+        if isinstance(handler, BoundedQueueHandler):
+            return handler.dropped
+
+    return None
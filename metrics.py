@@ -0,0 +1,222 @@
+import os
+import time
+import bisect
+import asyncio
+import logging
+
+
+log = logging.getLogger('bot')
+
+
+# Bucket upper bounds in seconds, for latencies from sub-millisecond queries to slow commands
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Counter:
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    __slots__ = ('value', )
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count', 'max')
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        # One more than there are buckets, for everything above the last one
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        # Estimated by interpolating linearly within the bucket the quantile falls into
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(lower + (upper - lower) * (rank - seen) / count, self.max)
+
+            seen += count
+
+        return self.max
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+
+def _format_labels(labels, **extra):
+    labels = (*labels, *extra.items())
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in labels) + '}'
+
+
+class Metrics:
+    # A registry of metric families, each a set of metrics of the same type with different labels.
+    # Metrics are plain objects that are updated in place, so recording is an attribute access and an add.
+    # Keep a reference to a metric you update often, instead of looking it up every time.
+
+    def __init__(self):
+        # name -> [type, help, {sorted label items: metric}]
+        self._families = {}
+
+        # Functions called before rendering, to update gauges from state kept elsewhere
+        self._collectors = []
+
+        self._tasks = []
+
+    def _get(self, kind, cls, name, help, labels, *args):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = [kind, help, {}]
+
+        elif family[0] != kind:
+            raise ValueError(f'Metric {name!r} is a {family[0]}, not a {kind}')
+
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = cls(*args)
+
+        return metric
+
+    def counter(self, name, help='', **labels):
+        return self._get('counter', Counter, name, help, labels)
+
+    def gauge(self, name, help='', **labels):
+        return self._get('gauge', Gauge, name, help, labels)
+
+    def histogram(self, name, help='', buckets=default_buckets, **labels):
+        return self._get('histogram', Histogram, name, help, labels, buckets)
+
+    def family(self, name):
+        # {label dict items: metric} for all metrics of a family
+        family = self._families.get(name)
+        return family[2] if family else {}
+
+    def add_collector(self, func):
+        self._collectors.append(func)
+
+    def collect(self):
+        for func in self._collectors:
+            try:
+                func()
+
+            except Exception:
+                log.error('Error in metrics collector', exc_info=True)
+
+    def render(self):
+        # Prometheus text exposition format
+        self.collect()
+        lines = []
+
+        for name, (kind, help, metrics) in sorted(self._families.items()):
+            if help:
+                lines.append(f'# HELP {name} {help}')
+
+            lines.append(f'# TYPE {name} {kind}')
+
+            for labels, metric in metrics.items():
+                if kind == 'histogram':
+                    cumulative = 0
+                    for bound, count in zip(metric.buckets, metric.counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_format_labels(labels, le=bound)} {cumulative}')
+
+                    lines.append(f'{name}_bucket{_format_labels(labels, le="+Inf")} {metric.count}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {metric.sum}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {metric.count}')
+
+                else:
+                    lines.append(f'{name}{_format_labels(labels)} {metric.value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # Written to a temporary file first, so readers never see a partial file
+        text = self.render()
+        tmp_path = f'{path}.tmp'
+
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+
+        os.replace(tmp_path, path)
+
+    def start(self, dump_path=None, *, lag_interval=0.5, dump_interval=60):
+        self._tasks.append(asyncio.create_task(self._sample_lag(lag_interval)))
+
+        if dump_path is not None:
+            self._tasks.append(asyncio.create_task(self._dump_periodically(dump_path, dump_interval)))
+
+    async def _sample_lag(self, interval):
+        # How much later than requested a sleep returns is how long other callbacks held up the loop
+        lag = self.histogram('event_loop_lag_seconds', 'Delay of a timer callback past its due time')
+        loop = asyncio.get_running_loop()
+
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag.observe(max(0.0, loop.time() - start - interval))
+
+    async def _dump_periodically(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+
+            try:
+                self.dump(path)
+
+            except OSError:
+                log.warning(f'Could not write metrics to {str(path)!r}', exc_info=True)
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+        self._tasks.clear()
+
+
+class Timer:
+    # Context manager observing the time its block took on a histogram
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
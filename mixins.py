@@ -1,15 +1,118 @@
+import io
+import gzip
+import asyncio
+import collections.abc
+
 import discord
+import discord.ext.commands
 
 from .common import *
 
 
-async def _send_paginated(self, *args, **kwargs):
-    for page in paginate(*args, **kwargs):
-        await self.send(page)
+# Discord's upload limit for bots in guilds without boosts
+MAX_ATTACHMENT_SIZE = 8 * 1024 * 1024
+
+# Attachments larger than this are gzipped
+COMPRESS_ATTACHMENT_OVER = 256 * 1024
+
+
+async def _text_items(content):
+    # The items of content as text, each of which starts a new line, like apaginate takes them
+    if isinstance(content, collections.abc.AsyncIterable):
+        async for item in content:
+            yield str(item)
+
+    elif isinstance(content, collections.abc.Iterator):
+        for item in content:
+            yield str(item)
+
+    else:
+        yield str(content)
+
+
+async def _send_paginated(self, content, prefix='```py\n', suffix='```', *, attach_over=3, filename='output.txt', max_pages=None, coalesce=False, **kwargs):
+    # Output of up to attach_over pages is sent as messages, cut off after max_pages. Anything longer is uploaded
+    # as a single file, which is one request instead of one rate limited request per page. The file has the
+    # output as it is, without the wrapping of the pages, and is cut off at MAX_ATTACHMENT_SIZE.
+    # With attach_over=None, everything is sent as messages.
+    # With coalesce=True, messages go through the outbox (if this is a Context) and may be merged with others.
+    # Returns the number of pages and bytes of output, and how it was sent.
+    send = getattr(self, 'send_coalesced', self.send) if coalesce else self.send
+
+    async def send_pages(pages):
+        num_pages = size = 0
+        last_page = ''
+
+        async for page in pages:
+            await send(page)
+            num_pages += 1
+            size += len(page.encode()) - len(prefix) - len(suffix)
+            last_page = page
+
+        return Obj(pages=num_pages, bytes=size, attached=False, compressed=False, truncated=last_page.endswith(TRUNCATION_MARKER + suffix))
+
+    if attach_over is None:
+        return await send_pages(apaginate(content, prefix, suffix, max_pages=max_pages, **kwargs))
+
+    # The pages without a budget tell us whether the output is too long for messages.
+    # The text they were made of is kept, for the messages or the file.
+    texts = []
+    text_size = 0
+
+    async def recorded():
+        nonlocal text_size
+        async for text in _text_items(content):
+            texts.append(text)
+            text_size += len(text.encode()) + 1
+            yield text
+
+    pages = apaginate(recorded(), prefix, suffix, **kwargs)
+    num_pages = 0
+
+    async for page in pages:
+        num_pages += 1
+        if num_pages > attach_over:
+            break
+
+    else:
+        return await send_pages(apaginate(iter(texts), prefix, suffix, max_pages=max_pages, **kwargs))
+
+    # Too long, the rest of the output only has to be read as far as it fits into the file
+    async for page in pages:
+        if text_size > MAX_ATTACHMENT_SIZE:
+            break
+
+        num_pages += 1
+
+    data = '\n'.join(texts).encode()
+    truncated = len(data) > MAX_ATTACHMENT_SIZE
+    if truncated:
+        # Without a character that was cut in half
+        data = data[:MAX_ATTACHMENT_SIZE - len(TRUNCATION_MARKER) - 1].decode(errors='ignore').encode()
+        data += f'\n{TRUNCATION_MARKER}'.encode()
+
+    size = len(data)
+    compressed = size > COMPRESS_ATTACHMENT_OVER
+
+    if compressed:
+        data = await asyncio.get_running_loop().run_in_executor(None, gzip.compress, data)
+        filename += '.gz'
+
+    await self.send(f'Output is {size} bytes ({num_pages}{"+" if truncated else ""} pages), attached as `{filename}`', file=discord.File(io.BytesIO(data), filename))
+
+    return Obj(pages=num_pages, bytes=size, attached=True, compressed=compressed, truncated=truncated)
 
 discord.abc.Messageable.send_paginated = _send_paginated
 
 
+def _send_coalesced(self, content):
+    # Sends a short text message through the bot's outbox, which may merge it with others sent to the
+    # same channel around the same time. Returns an awaitable for the message it ended up in.
+    return self.bot.outbox.send(self.channel, content)
+
+discord.ext.commands.Context.send_coalesced = _send_coalesced
+
+
 async def _add_success_reaction(self, success):
     await self.message.add_reaction('\N{HEAVY CHECK MARK}' if success else '\N{CROSS MARK}')
 
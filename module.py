@@ -5,12 +5,15 @@ import typing
 import asyncio
 import inspect
 import logging
-import importlib
 from datetime import datetime as dt, timezone as tz
 
 from discord.backoff import ExponentialBackoff
 from discord.ext import commands as cmd
 
+from . import scheduler
+from . import ratelimit
+from . import reloader
+
 
 # Currently, the module system is just a wrapper over the
 # cog and extension system provided by the commands library, with some minor extensions.
@@ -26,10 +29,12 @@ CheckFailure = cmd.CheckFailure
 
 parent_module = __name__.rsplit('.', maxsplit=1)[0]
 
+log = logging.getLogger('bot')
+
 
 def get_logger():
-    calling_frame = inspect.stack()[1].frame
-    module_name = inspect.getmodule(calling_frame).__name__
+    # inspect.stack() would build (and read the source for) every frame on the stack, we just need the caller's
+    module_name = sys._getframe(1).f_globals['__name__']
 
     prefix = f'{parent_module}.modules.'
     if module_name.startswith(prefix):
@@ -39,21 +44,127 @@ def get_logger():
 
 
 
+class ConfigStore:
+    # Write-behind storage for Config objects.
+    # Each key is stored in its own row, so changing one key doesn't rewrite the others.
+    # Changes are staged in memory and written by a background flush, which coalesces
+    # everything staged during flush_interval into a single transaction.
+    # Staged changes that haven't been flushed yet are lost if the process dies,
+    # so Gs6Ex.close() calls close() to write them out.
+    #
+    # preload() reads the whole table with a single query, so loading lots of modules
+    # at startup doesn't cost a db round trip each. The snapshot is kept up to date by stage(),
+    # so it stays valid for modules that are loaded (or reloaded) later.
+
+    def __init__(self, db, *, flush_interval=1.0):
+        self._db = db
+        self.flush_interval = flush_interval
+
+        # (config name, key) -> pickled value
+        self._pending = {}
+
+        # config name -> {key: pickled value}, or None if not preloaded
+        self._snapshot = None
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    async def preload(self):
+        snapshot = {}
+        for name, key, data in await self._db.fetchall('SELECT name, key, data FROM config_items;'):
+            snapshot.setdefault(name, {})[key] = data
+
+        # Staged changes are newer than what's in the db
+        for (name, key), data in self._pending.items():
+            snapshot.setdefault(name, {})[key] = data
+
+        self._snapshot = snapshot
+
+    async def load(self, name):
+        if self._snapshot is not None:
+            return dict(self._snapshot.get(name, {}))
+
+        items = dict(await self._db.fetchall('SELECT key, data FROM config_items WHERE name = ?;', (name, )))
+
+        # Staged changes are newer than what's in the db
+        items.update((key, data) for (n, key), data in self._pending.items() if n == name)
+        return items
+
+    def stage(self, name, key, data):
+        self._pending[name, key] = data
+
+        if self._snapshot is not None:
+            self._snapshot.setdefault(name, {})[key] = data
+
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+
+        try:
+            await self.flush()
+
+        except Exception:
+            log.error('Error flushing config changes, will retry with the next change', exc_info=True)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            pending, self._pending = self._pending, {}
+
+            try:
+                async with self._db.transaction() as tx:
+                    await tx.executemany(
+                        'INSERT OR REPLACE INTO config_items (name, key, data) VALUES (?, ?, ?);',
+                        [(name, key, data) for (name, key), data in pending.items()])
+
+            except Exception:
+                # Put the changes back, unless they have been staged again in the meantime
+                for item, data in pending.items():
+                    self._pending.setdefault(item, data)
+
+                raise
+
+            log.debug(f'Flushed {len(pending)} config changes')
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+        await self.flush()
+
+
 class Config:
-    def __init__(self, db, name):
-        super().__setattr__('_db', db)
+    def __init__(self, store, name):
+        super().__setattr__('_store', store)
         super().__setattr__('_name', name)
         super().__setattr__('_props', copy.deepcopy(self._defaults))
 
+        # Pickled value of each key, as last loaded or committed.
+        # Values are often mutated in place (conf.superusers.add(...)), so we can't
+        # track dirty keys in __setattr__. Instead, we compare against this on commit.
+        super().__setattr__('_committed', {})
+
     async def load(self):
-        async with self._db.execute('SELECT data FROM config WHERE name = ?;', (self._name, )) as cursor:
-            if result := await cursor.fetchone():
-                data, = result
-                self._props.update(pickle.loads(data))
+        items = await self._store.load(self._name)
+
+        for key, data in items.items():
+            self._props[key] = pickle.loads(data)
+
+        self._committed.update(items)
 
     async def commit(self):
-        await self._db.execute('INSERT OR REPLACE INTO config (name, data) VALUES (?, ?);', (self._name, pickle.dumps(self._props)))
-        await self._db.commit()
+        # This only stages the changed keys, the ConfigStore writes them in the background
+        for key, value in self._props.items():
+            data = pickle.dumps(value)
+
+            if data != self._committed.get(key):
+                self._committed[key] = data
+                self._store.stage(self._name, key, data)
 
     def __getattr__(self, key):
         return self._props[key]
@@ -72,12 +183,15 @@ class Config:
 
 
 class Module(cmd.Cog):
+    # Names of the modules that have to be loaded before this one.
+    # They are loaded automatically if they aren't yet.
+    dependencies = ()
+
     def __init__(self, bot):
         self.bot = bot
         if hasattr(self, 'Config'):
-            self.conf = self.Config(bot.db, self.name)
+            self.conf = self.Config(bot.config_store, self.name)
         self.log = logging.getLogger(f'bot.{self.name}')
-        self._scheduled_tasks = set()
 
     async def _on_load(self):
         if hasattr(self, 'conf'):
@@ -85,6 +199,8 @@ class Module(cmd.Cog):
         
         if hasattr(self, 'on_load'):
             await self.on_load()
+
+        await self.bot.job_store.restore(self)
         
         self.log.info('Loaded!')
 
@@ -92,12 +208,15 @@ class Module(cmd.Cog):
         if hasattr(self, 'on_unload'):
             await self.on_unload()
         
-        for task in self._scheduled_tasks:
-            task.cancel()
+        self.bot.scheduler.cancel_owner(self)
 
         self.log.info('Unloaded!')
 
-    def schedule_task(self, coro, *, in_delta=None, at_datetime=None):
+    def schedule_task(self, coro, *args, in_delta=None, at_datetime=None):
+        # coro is either a coroutine function, which is called with args when the job is due,
+        # or a coroutine object. Prefer the former for jobs far in the future,
+        # since a coroutine object keeps its frame alive until then.
+        # Returns a ScheduledJob, which can be cancelled.
         if in_delta is not None:
             in_seconds = in_delta.total_seconds()
 
@@ -107,49 +226,48 @@ class Module(cmd.Cog):
         else:
             raise TypeError('Must supply either in_delta or at_datetime')
 
-        async def scheduled_closure():
-            try:
-                await asyncio.sleep(in_seconds)
-                await coro
+        return self.bot.scheduler.schedule_in(in_seconds, coro, *args, owner=self)
 
-            finally:
-                self._scheduled_tasks.discard(asyncio.current_task())
+    async def schedule_persistent(self, handler, *args, in_delta=None, at_datetime=None):
+        # Like schedule_task, but the job is stored in the database, so it survives restarts.
+        # handler is a coroutine method of this module (or its name), args must be picklable.
+        # Jobs that became due while the bot was down are run when the module is loaded.
+        # Returns a job id for cancel_persistent.
+        if in_delta is not None:
+            due = dt.now(tz.utc) + in_delta
 
-        task = asyncio.create_task(scheduled_closure())
-        self._scheduled_tasks.add(task)
-        return task
+        elif at_datetime is not None:
+            due = at_datetime
 
-    def schedule_repeated(self, coro, *args, every_delta):
-        async def scheduled_closure():
-            try:
-                while True:
-                    try:
-                        await coro(*args)
+        else:
+            raise TypeError('Must supply either in_delta or at_datetime')
 
-                    except asyncio.CancelledError:
-                        return
+        handler = getattr(handler, '__name__', handler)
+        if not inspect.iscoroutinefunction(getattr(self, handler, None)):
+            raise TypeError(f'{handler!r} is not a coroutine method of {type(self).__name__}')
 
-                    except Exception:
-                        self.log.error('Exception in repeated schedule:', exc_info=True)
+        return await self.bot.job_store.add(self, handler, args, due.timestamp())
 
-                    await asyncio.sleep(every_delta.total_seconds())
+    async def cancel_persistent(self, job_id):
+        # Cancels a job of this module. Returns False if it has no job with that id (any more).
+        return await self.bot.job_store.cancel(self, job_id)
 
-            finally:
-                self._scheduled_tasks.discard(asyncio.current_task())
+    def schedule_repeated(self, coro, *args, every_delta, fixed_rate=True, missed='coalesce', jitter=None):
+        # Runs coro(*args) every every_delta, until cancelled or the module is unloaded.
+        # See scheduler.RepeatedJob for the fixed_rate, missed and jitter options.
+        # Returns the RepeatedJob, which can be cancelled and keeps run time and lag stats.
+        return scheduler.RepeatedJob(
+            self.bot.scheduler, coro, args, every_delta.total_seconds(),
+            fixed_rate=fixed_rate, missed=missed, jitter=jitter.total_seconds() if jitter else 0, owner=self)
 
-        task = asyncio.create_task(scheduled_closure())
-        self._scheduled_tasks.add(task)
-        return task
+_reloader = reloader.Reloader(f'{parent_module}.modules')
 
 def get_module_class(name):
-    # First we (re)load the python module containing the module class
-    module_path = f'{parent_module}.modules.{name}'
-    
-    if module_path in sys.modules:
-        py_module = importlib.reload(sys.modules[module_path])
-
-    else:
-        py_module = importlib.import_module(module_path)
+    # First we import the python module containing the module class.
+    # If it was imported before, it is reloaded if it or any of the helpers it imports changed.
+    py_module, reloaded = _reloader.import_module(name)
+    if reloaded:
+        log.info(f'Reloaded python modules {", ".join(reloaded)}')
 
     # Get a list of Module subclasses defined in the python module
     module_classes = inspect.getmembers(py_module, lambda x: inspect.isclass(x) and issubclass(x, Module))
@@ -167,6 +285,18 @@ def get_module_class(name):
     return module_classes[0][1]
 
 
+def modules_using_files(paths):
+    # Names of the modules whose code is in one of the files in paths, or uses a helper that is
+    return {name[len(_reloader.prefix):].partition('.')[0] for name in _reloader.importers_of_files(paths)}
+
+
+def is_stale(instance):
+    # Whether the python module defining a loaded module's class was reloaded since it was loaded,
+    # or it still uses the old version of a helper that was reloaded for another module
+    cls = type(instance)
+    return getattr(sys.modules.get(cls.__module__), cls.__qualname__, None) is not cls or cls.__module__ in _reloader.stale()
+
+
 def is_owner():
     async def pred(ctx):
         return await ctx.bot.is_owner(ctx.author)
@@ -178,3 +308,19 @@ def is_superuser():
         return await ctx.bot.is_superuser(ctx.author)
 
     return cmd.check(pred)
+
+
+def rate_limit(rate, per, *, scope='user', burst=None):
+    # Allow rate invocations every per seconds (and at most burst at once) for each user/channel/guild,
+    # or for everyone together with scope='global'. Invocations over the limit are silently ignored.
+    def decorator(func):
+        return ratelimit.add_limit(func, ratelimit.RateLimit(rate, per, scope=scope, burst=burst))
+
+    return decorator
+
+def concurrency_limit(number, *, scope='global'):
+    # Allow at most number invocations to run at the same time. Further ones are silently ignored.
+    def decorator(func):
+        return ratelimit.add_limit(func, ratelimit.ConcurrencyLimit(number, scope=scope))
+
+    return decorator
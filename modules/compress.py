@@ -1,6 +1,12 @@
+import abc
+import sys
+import lzma
+import zlib
 import pickle
+import functools
 import pickletools
-import lzma
+from array import array
+from pathlib import Path
 
 
 char_ranges = {
@@ -31,7 +37,7 @@ for num_of_bits, ranges in char_ranges.items():
         decode_lut[char] = (num_of_bits, z)
 
 
-def _base32768_encode_raw(data):
+def _base32768_encode_scalar(data):
     digits = []
 
     bit_buffer = 0
@@ -53,7 +59,7 @@ def _base32768_encode_raw(data):
 
     return ''.join(digits)
 
-def _base32768_decode_raw(data):
+def _base32768_decode_scalar(data):
     output = bytearray()
 
     bit_buffer = 0
@@ -76,22 +82,408 @@ def _base32768_decode_raw(data):
 
     return output
 
-lzma_filter_chain = [{'id': lzma.FILTER_LZMA2, 'preset': 9}]
 
-def base32768_encode_bytes(data):
-    compressed = lzma.compress(data, format=lzma.FORMAT_RAW, filters=lzma_filter_chain)
-    return _base32768_encode_raw(compressed)
+# The scalar functions above shift one byte or char at a time through the bit buffer,
+# which is very slow for anything but tiny inputs.
+# The block codec below works on 15 byte <-> 8 char blocks instead (120 bits, so the
+# bit buffer is always empty at block boundaries), and handles a whole slab of blocks
+# at once using big int arithmetic:
+# Each 15 byte block is widened to 16 bytes, the slab is turned into one big int,
+# and the 8 15-bit digits of every block are moved into 16-bit slots using one shift and
+# mask per digit position. After that, the digits are just an array('H').
+# Decoding does the same thing backwards.
+# Anything that doesn't fill a whole block (the tail) still goes through the scalar functions,
+# so the output, tail chars and padding check are exactly the same as before.
+
+block_bytes = 15
+block_chars = 8
+slab_blocks = 4096
+
+# Below this, the setup cost of the block codec isn't worth it
+min_blocks = 8
+
+block_encode_lut = tuple(encode_lut[15])
+
+# Maps UTF-16 code units to 15-bit digits.
+# Anything that isn't a 15-bit digit maps to 0x10000, which doesn't fit into an array('H').
+block_decode_lut = [0x10000] * 0x10000
+
+for z, char in enumerate(block_encode_lut):
+    block_decode_lut[ord(char)] = z
+
+_utf16_native = 'utf-16-le' if sys.byteorder == 'little' else 'utf-16-be'
+_swap_bytes = sys.byteorder == 'little'
+
+
+@functools.lru_cache(maxsize=8)
+def _slab_mask(num_blocks):
+    # 0x7fff at the bottom of every 16 byte slot
+    return int.from_bytes((0x7fff).to_bytes(16, 'big') * num_blocks, 'big')
+
+def _encode_blocks(data):
+    # len(data) must be a multiple of block_bytes
+    chunks = []
+
+    for start in range(0, len(data), block_bytes * slab_blocks):
+        slab = data[start:start + block_bytes * slab_blocks]
+        num_blocks = len(slab) // block_bytes
+
+        wide = bytearray(16 * num_blocks)
+        for i in range(block_bytes):
+            wide[i + 1::16] = slab[i::block_bytes]
+
+        blocks = int.from_bytes(wide, 'big')
+        mask = _slab_mask(num_blocks)
+
+        digits = blocks & mask
+        for i in range(1, block_chars):
+            digits |= ((blocks >> (15 * i)) & mask) << (16 * i)
+
+        digits = array('H', digits.to_bytes(16 * num_blocks, 'big'))
+        if _swap_bytes:
+            digits.byteswap()
+
+        chunks.append(''.join([block_encode_lut[d] for d in digits]))
+
+    return ''.join(chunks)
+
+def _decode_blocks(data):
+    # len(data) must be a multiple of block_chars.
+    # Raises OverflowError or UnicodeEncodeError for chars that aren't 15-bit digits.
+    output = bytearray()
+
+    for start in range(0, len(data), block_chars * slab_blocks):
+        slab = data[start:start + block_chars * slab_blocks]
+        num_blocks = len(slab) // block_chars
+
+        digits = array('H', [block_decode_lut[c] for c in array('H', slab.encode(_utf16_native))])
+        if _swap_bytes:
+            digits.byteswap()
+
+        digits = int.from_bytes(digits, 'big')
+        mask = _slab_mask(num_blocks)
+
+        blocks = digits & mask
+        for i in range(1, block_chars):
+            blocks |= ((digits >> (16 * i)) & mask) << (15 * i)
+
+        wide = blocks.to_bytes(16 * num_blocks, 'big')
+        decoded = bytearray(block_bytes * num_blocks)
+        for i in range(block_bytes):
+            decoded[i::block_bytes] = wide[i + 1::16]
+
+        output += decoded
+
+    return output
+
+def _base32768_encode_raw(data):
+    if len(data) < block_bytes * min_blocks:
+        return _base32768_encode_scalar(data)
+
+    data = memoryview(data).cast('B')
+    split = len(data) - len(data) % block_bytes
+    return _encode_blocks(data[:split]) + _base32768_encode_scalar(data[split:])
+
+def _base32768_decode_raw(data):
+    if len(data) < block_chars * min_blocks:
+        return _base32768_decode_scalar(data)
+
+    # The last char may be padded, so it always goes through the scalar decoder.
+    split = (len(data) - 1) // block_chars * block_chars
+
+    try:
+        output = _decode_blocks(data[:split])
+
+    except (OverflowError, UnicodeEncodeError):
+        # Not a well formed string. Let the scalar decoder deal with it.
+        return _base32768_decode_scalar(data)
+
+    output += _base32768_decode_scalar(data[split:])
+    return output
+
+# Codecs
+#
+# Every encoded string starts with a one char tag, which selects the codec used to compress it.
+# Tags are always ASCII, which never appears in the base32768 alphabet, so strings
+# from before codecs existed (raw LZMA2 at preset 9, without a tag) can still be decoded.
+#
+# Compressors and decompressors have the same interface as the ones in the lzma and zlib modules,
+# except that codec.finish(decompressor) has to be called after the last chunk of input.
+
+class Codec(abc.ABC):
+    def __init__(self, tag, name):
+        assert len(tag) == 1 and tag.isascii(), 'Codec tags must be a single ASCII char'
+        self.tag = tag
+        self.name = name
+
+    @abc.abstractmethod
+    def compressobj(self):
+        pass
+
+    @abc.abstractmethod
+    def decompressobj(self):
+        pass
+
+    def finish(self, decompressor):
+        # Returns any remaining output and makes sure the stream was complete
+        if not decompressor.eof:
+            raise ValueError(f'Invalid base32768 string ({self.name} data is truncated)')
+
+        return b''
+
+    def __repr__(self):
+        return f'<{type(self).__name__} {self.tag!r} {self.name!r}>'
+
+
+class StoredCodec(Codec):
+    class Stored:
+        eof = True
+
+        def compress(self, data):
+            return bytes(data)
+
+        def flush(self):
+            return b''
+
+        decompress = compress
+
+    def compressobj(self):
+        return self.Stored()
+
+    def decompressobj(self):
+        return self.Stored()
+
+
+class LZMACodec(Codec):
+    def __init__(self, tag, name, preset):
+        super().__init__(tag, name)
+        self.filters = [{'id': lzma.FILTER_LZMA2, 'preset': preset}]
+
+    def compressobj(self):
+        return lzma.LZMACompressor(format=lzma.FORMAT_RAW, filters=self.filters)
+
+    def decompressobj(self):
+        return lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=self.filters)
+
+
+class ZlibCodec(Codec):
+    def __init__(self, tag, name, level, zdict=None):
+        # zdict is the file name of a preset dictionary, see load_zdict
+        super().__init__(tag, name)
+        self.level = level
+        self.zdict = zdict
+
+    def compressobj(self):
+        if self.zdict:
+            # Using the zlib format instead of raw deflate costs 6 bytes,
+            # but the header contains a checksum of the dictionary, so a mismatch is detected.
+            return zlib.compressobj(self.level, zlib.DEFLATED, 15, zdict=load_zdict(self.zdict))
+
+        return zlib.compressobj(self.level, zlib.DEFLATED, -15)
+
+    def decompressobj(self):
+        if self.zdict:
+            return zlib.decompressobj(15, zdict=load_zdict(self.zdict))
+
+        return zlib.decompressobj(-15)
+
+    def finish(self, decompressor):
+        output = decompressor.flush()
+        return output + super().finish(decompressor)
+
+
+@functools.lru_cache(maxsize=None)
+def load_zdict(name):
+    # Short snippets don't contain enough repetition to compress well on their own,
+    # but they mostly look like the bot's own code, so we use that as a preset dictionary.
+    # Both sides need the exact same dictionary, so dictionary files are frozen: once payloads
+    # using one exist, it must never change. A better dictionary gets a new file and codec tag.
+    # zdict_v1.bin is the bot's own sources (deflate only looks back 32 KiB) as of when it was added.
+    return (Path(__file__).parent / name).read_bytes()
+
+
+codecs = {}
+
+def register_codec(codec):
+    assert codec.tag not in codecs, f'Codec tag {codec.tag!r} is already used by {codecs[codec.tag]!r}'
+    codecs[codec.tag] = codec
+    return codec
+
+def get_codec(name):
+    # Accepts a codec, its tag, or its name
+    if isinstance(name, Codec):
+        return name
+
+    if name in codecs:
+        return codecs[name]
+
+    for codec in codecs.values():
+        if codec.name == name:
+            return codec
+
+    raise KeyError(f'Unknown codec {name!r}')
+
+
+register_codec(StoredCodec('n', 'none'))
+register_codec(ZlibCodec('z', 'zlib', 9))
+register_codec(ZlibCodec('d', 'zlib-dict-v1', 9, zdict='zdict_v1.bin'))
+register_codec(LZMACodec('f', 'lzma-fast', 1))
+register_codec(LZMACodec('l', 'lzma', 6))
+register_codec(LZMACodec('x', 'lzma-extreme', 9))
+
+# Untagged strings
+legacy_codec = codecs['x']
+
+# (max input size, codec name), checked in order. See benchmarks/compression.py.
+# Preset 9 compresses no better than 6 for anything we send, but allocates a 64 MiB dictionary.
+auto_codecs = (
+    (16 * 1024, 'zlib-dict-v1'),
+    (None, 'lzma'),
+)
+
+def choose_codec(size):
+    for max_size, name in auto_codecs:
+        if max_size is None or size <= max_size:
+            return get_codec(name)
+
+def _split_tag(data):
+    if data and data[0].isascii():
+        if data[0] not in codecs:
+            raise ValueError(f'Invalid base32768 string (unknown codec tag {data[0]!r})')
+
+        return codecs[data[0]], data[1:]
+
+    return legacy_codec, data
+
+def _compress(data, codec):
+    if codec is None:
+        codec = choose_codec(len(data))
+        compressor = codec.compressobj()
+        compressed = compressor.compress(data) + compressor.flush()
+
+        # Tiny inputs can come out larger than they went in
+        if len(compressed) >= len(data):
+            codec, compressed = codecs['n'], bytes(data)
+
+    else:
+        codec = get_codec(codec)
+        compressor = codec.compressobj()
+        compressed = compressor.compress(data) + compressor.flush()
+
+    return codec.tag + _base32768_encode_raw(compressed)
+
+def _decompress(data):
+    codec, data = _split_tag(data)
+    decompressor = codec.decompressobj()
+    output = decompressor.decompress(_base32768_decode_raw(data))
+    return output + codec.finish(decompressor)
+
+def base32768_encode_bytes(data, codec=None):
+    return _compress(data, codec)
 
 def base32768_decode_bytes(data):
-    decoded = _base32768_decode_raw(data)
-    return lzma.decompress(decoded, format=lzma.FORMAT_RAW, filters=lzma_filter_chain)
+    return _decompress(data)
 
-def base32768_encode_object(obj):
+def base32768_encode_object(obj, codec=None):
     pickled = pickletools.optimize(pickle.dumps(obj, protocol=5))
-    compressed = lzma.compress(pickled, format=lzma.FORMAT_RAW, filters=lzma_filter_chain)
-    return _base32768_encode_raw(compressed)
+    return _compress(pickled, codec)
 
 def base32768_decode_object(data):
-    decoded = _base32768_decode_raw(data)
-    decompressed = lzma.decompress(decoded, format=lzma.FORMAT_RAW, filters=lzma_filter_chain)
-    return pickle.loads(decompressed)
+    return pickle.loads(_decompress(data))
+
+
+class Base32768Compressor:
+    # Incremental version of base32768_encode_bytes, with the same interface as lzma.LZMACompressor.
+    # compress() returns the encoded str for as much data as can be encoded so far,
+    # flush() returns the rest. Concatenated, they are identical to base32768_encode_bytes(data, codec).
+    # Since the input size isn't known up front, the codec can't be chosen automatically.
+
+    def __init__(self, codec='lzma'):
+        self.codec = get_codec(codec)
+        self._compressor = self.codec.compressobj()
+
+        # Compressed bytes that don't fill a whole block yet.
+        # This is the bit buffer of the scalar encoder, carried over between calls.
+        self._pending = bytearray()
+        self._tag = self.codec.tag
+        self._flushed = False
+
+    def _encode(self, split):
+        encoded = self._tag + _base32768_encode_raw(bytes(self._pending[:split]))
+        del self._pending[:split]
+        self._tag = ''
+        return encoded
+
+    def compress(self, data):
+        if self._flushed:
+            raise ValueError('Compressor has been flushed')
+
+        self._pending += self._compressor.compress(data)
+        return self._encode(len(self._pending) - len(self._pending) % block_bytes)
+
+    def flush(self):
+        if self._flushed:
+            raise ValueError('Repeated call to flush()')
+
+        self._flushed = True
+        self._pending += self._compressor.flush()
+        return self._encode(len(self._pending))
+
+
+class Base32768Decompressor:
+    # Incremental version of base32768_decode_bytes, with the same interface as lzma.LZMADecompressor.
+    # decompress() accepts the encoded str in arbitrary chunks. Because the last char may be padded,
+    # the padding can only be checked once the input is complete, so flush() must be called at the end.
+
+    def __init__(self):
+        # Set once we have seen the tag
+        self.codec = None
+        self._decompressor = None
+
+        # Chars that don't fill a whole block yet, plus the (possibly padded) last char
+        self._pending = ''
+        self._flushed = False
+
+    @property
+    def eof(self):
+        return self._decompressor is not None and self._decompressor.eof
+
+    def decompress(self, data):
+        if self._flushed:
+            raise ValueError('Decompressor has been flushed')
+
+        if self.codec is None:
+            if not data:
+                return b''
+
+            self.codec, data = _split_tag(data)
+            self._decompressor = self.codec.decompressobj()
+
+        pending = self._pending + data
+        split = (len(pending) - 1) // block_chars * block_chars if pending else 0
+
+        try:
+            decoded = _decode_blocks(pending[:split])
+
+        except (OverflowError, UnicodeEncodeError):
+            raise ValueError('Invalid base32768 string (invalid character)') from None
+
+        self._pending = pending[split:]
+        return self._decompressor.decompress(decoded)
+
+    def flush(self):
+        if self._flushed:
+            raise ValueError('Repeated call to flush()')
+
+        self._flushed = True
+
+        if self.codec is None:
+            # Empty input. The legacy format encodes nothing as nothing.
+            self.codec = legacy_codec
+            self._decompressor = self.codec.decompressobj()
+
+        decoded = _base32768_decode_scalar(self._pending)
+        self._pending = ''
+
+        output = self._decompressor.decompress(decoded)
+        return output + self.codec.finish(self._decompressor)
@@ -15,7 +15,7 @@ class ConfUtilModule(mod.Module):
     async def get_cmd(self, ctx, module: str):
         if module not in self.bot.modules:
             await ctx.add_success_reaction(False)
-            await ctx.send(f"Module {module!r} is not loaded.")
+            await ctx.send_coalesced(f"Module {module!r} is not loaded.")
             return
 
         await ctx.send_paginated(f'{{\n{NEW_LINE.join(f"    {k!r}: {v!r}," for k, v in self.bot.modules[module].conf.items())}\n}}')
@@ -25,7 +25,7 @@ class ConfUtilModule(mod.Module):
     async def set_cmd(self, ctx, module: str, key: str, *, value):
         if module not in self.bot.modules:
             await ctx.add_success_reaction(False)
-            await ctx.send(f"Module {module!r} is not loaded.")
+            await ctx.send_coalesced(f"Module {module!r} is not loaded.")
             return
 
         try:
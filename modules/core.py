@@ -1,11 +1,17 @@
+import io
 import asyncio
+import hashlib
 import inspect
+import logging
 import textwrap
 from datetime import datetime as dt, timezone as tz
 
 import discord
 
 import gs6ex.module as mod
+import gs6ex.logs as logs
+import gs6ex.profiler as profiler
+import gs6ex.workers as workers
 from . import compress
 
 
@@ -24,7 +30,109 @@ def clean_code(content):
     return content.strip('`').strip()
 
 
+def parse_worker_flag(content):
+    # eval, exec and execc run the code in a worker process when it is preceded by --worker.
+    # Returns whether it was, and the rest of the content.
+    content = content.lstrip()
+    flag = '--worker'
+
+    if content.startswith(flag) and content[len(flag):len(flag) + 1].isspace():
+        return True, content[len(flag):]
+
+    return False, content
+
+
+def compile_exec(code, filename='<exec>'):
+    # exec code is the body of an async function, so it can use await and return a result
+    return compile(f'import asyncio\nasync def _func():\n{textwrap.indent(code, "    ")}', filename, 'exec')
+
+
+def compile_payload(payload):
+    # Compiles an execc payload (base32768 encoded, compressed code)
+    return compile_exec(compress.base32768_decode_bytes(payload).decode(), '<execc>')
+
+
+class CodeCache:
+    # LRU cache of compiled execc payloads, keyed by a hash of the payload.
+    # Saves decoding, decompressing and compiling snippets that are run over and over.
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        # key -> code object, least recently used first
+        self._code = {}
+
+    @staticmethod
+    def key(payload):
+        return hashlib.blake2b(payload.encode(), digest_size=16).digest()
+
+    def get(self, key):
+        code = self._code.pop(key, None)
+        if code is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._code[key] = code
+        return code
+
+    def put(self, key, code):
+        self._code.pop(key, None)
+        self._code[key] = code
+
+        while len(self._code) > self.max_size:
+            del self._code[next(iter(self._code))]
+
+    def discard(self, key):
+        self._code.pop(key, None)
+
+    def __len__(self):
+        return len(self._code)
+
+
 class CoreModule(mod.Module):
+    class Config(mod.Config):
+        # For eval, exec and execc with --worker
+        worker_processes: int = 2
+        worker_timeout: float = 10.0
+        worker_memory_mb: int = 512
+
+    _workers = None
+
+    def __init__(self, bot):
+        super().__init__(bot)
+        self.code_cache = CodeCache()
+
+    @property
+    def workers(self):
+        # Started on first use, and kept around from then on
+        if self._workers is None:
+            self._workers = workers.WorkerPool(self.conf.worker_processes, memory_limit=self.conf.worker_memory_mb * 1024 * 1024)
+
+        return self._workers
+
+    async def on_unload(self):
+        if self._workers is not None:
+            self._workers.close()
+
+    async def send_worker_results(self, ctx, results):
+        # Pages are sent as the results come in. If there are none at all, just react.
+        try:
+            first = await results.__anext__()
+
+        except StopAsyncIteration:
+            await ctx.add_success_reaction(True)
+            return
+
+        async def all_results():
+            yield first
+            async for result in results:
+                yield result
+
+        await ctx.send_paginated(all_results())
+
     def create_env(self, ctx):
         env = {
             'bot': self.bot,
@@ -34,11 +142,41 @@ class CoreModule(mod.Module):
         env.update(globals())
         return env
 
-    @mod.command(name='eval', usage='eval <code>', description='Evaluate a piece of python code')
+    async def run_compiled(self, ctx, code):
+        # Runs code from compile_exec and sends the result, if there is one
+        env = self.create_env(ctx)
+        exec(code, env)
+
+        result = await env['_func']()
+
+        if result is not None:
+            await ctx.send_paginated(result)
+
+    def compile_cached(self, payload):
+        key = self.code_cache.key(payload)
+
+        code = self.code_cache.get(key)
+        if code is None:
+            code = compile_payload(payload)
+            self.code_cache.put(key, code)
+
+        return code
+
+    # With --worker, code runs in a worker process (see workers.py), where it can't block the bot,
+    # but doesn't have bot or ctx. exec code is a plain function body there, so it can't use await.
+
+    @mod.command(name='eval', usage='eval [--worker] <code>', description='Evaluate a piece of python code')
     @mod.is_owner()
+    @mod.rate_limit(5, 10)
+    @mod.concurrency_limit(1, scope='user')
     async def eval_cmd(self, ctx, *, code: str):
+        in_worker, code = parse_worker_flag(code)
         code = clean_code(code)
 
+        if in_worker:
+            await self.send_worker_results(ctx, self.workers.run('eval', code, timeout=self.conf.worker_timeout))
+            return
+
         result = eval(code, self.create_env(ctx))
         if inspect.isawaitable(result):
             result = await result
@@ -51,38 +189,37 @@ class CoreModule(mod.Module):
             pass
         
         else:
-            await ctx.send_paginated(error)
+            await ctx.send_paginated(error, coalesce=True)
 
-    @mod.command(name='exec', usage='exec <code>', description='Execute a piece of python code')
+    @mod.command(name='exec', usage='exec [--worker] <code>', description='Execute a piece of python code')
     @mod.is_owner()
+    @mod.rate_limit(5, 10)
+    @mod.concurrency_limit(1, scope='user')
     async def exec_cmd(self, ctx, *, code: str):
+        in_worker, code = parse_worker_flag(code)
         code = clean_code(code)
 
-        env = self.create_env(ctx)
-        code = f'import asyncio\nasync def _func():\n{textwrap.indent(code, "    ")}'
-
-        exec(code, env)
+        if in_worker:
+            await self.send_worker_results(ctx, self.workers.run('exec', code, timeout=self.conf.worker_timeout))
+            return
 
-        result = await env['_func']()
+        await self.run_compiled(ctx, compile_exec(code))
 
-        if result is not None:
-            await ctx.send_paginated(result)
-
-    @mod.command(name='execc', usage='execc <code>', description='Execute a compressed piece of python code')
+    @mod.command(name='execc', usage='execc [--worker] <code>', description='Execute a compressed piece of python code')
     @mod.is_owner()
+    @mod.rate_limit(5, 10)
+    @mod.concurrency_limit(1, scope='user')
     async def execc_cmd(self, ctx, *, code: str):
+        in_worker, code = parse_worker_flag(code)
         code = clean_code(code)
-        code = compress.base32768_decode_bytes(code).decode()
 
-        env = self.create_env(ctx)
-        code = f'import asyncio\nasync def _func():\n{textwrap.indent(code, "    ")}'
+        if in_worker:
+            # Workers compile the source themselves, so the code cache doesn't help here
+            source = compress.base32768_decode_bytes(code).decode()
+            await self.send_worker_results(ctx, self.workers.run('exec', source, timeout=self.conf.worker_timeout))
+            return
 
-        exec(code, env)
-
-        result = await env['_func']()
-
-        if result is not None:
-            await ctx.send_paginated(result)
+        await self.run_compiled(ctx, self.compile_cached(code))
 
     @exec_cmd.error
     async def exec_err(self, ctx, error):
@@ -90,8 +227,98 @@ class CoreModule(mod.Module):
             pass
         
         else:
-            await ctx.send_paginated(error)
+            await ctx.send_paginated(error, coalesce=True)
+
+    @mod.command(name='loglevel', usage='loglevel [logger] [level|reset]', description='Show or change log levels')
+    @mod.is_owner()
+    async def loglevel_cmd(self, ctx, name: str = None, level: str = None):
+        # Module names are accepted as a shorthand for their logger
+        if name in self.bot.modules:
+            name = f'bot.{name}'
+
+        log_levels = self.bot.conf.log_levels
+
+        if level is None:
+            names = [name] if name else sorted({'bot', 'discord', *(f'bot.{m}' for m in self.bot.modules), *log_levels})
+            lines = [f'{n:<24} {logging.getLevelName(logging.getLogger(n).getEffectiveLevel())}{" (set)" if n in log_levels else ""}' for n in names]
+
+            dropped = logs.dropped_records()
+            if dropped is not None:
+                lines.append(f'\nDropped records: {dropped}')
+
+            await ctx.send_paginated('\n'.join(lines), '```prolog\n', coalesce=True)
+            return
+
+        if level.lower() == 'reset':
+            log_levels.pop(name, None)
+            logs.reset_level(name)
+
+        else:
+            try:
+                logging.getLogger(name).setLevel(logs.parse_level(level))
+
+            except ValueError:
+                await ctx.add_success_reaction(False)
+                raise
+
+            log_levels[name] = level.upper()
+
+        await self.bot.conf.commit()
+        await ctx.add_success_reaction(True)
+
+    @mod.command(name='stats', usage='stats', description='Show command, event loop and database timings')
+    @mod.is_owner()
+    async def stats_cmd(self, ctx):
+        metrics = self.bot.metrics
+        metrics.collect()
+
+        def ms(seconds):
+            return f'{seconds * 1000:.1f}'
+
+        def timings(h):
+            return f'{h.count:>7} {ms(h.quantile(0.5)):>8} {ms(h.quantile(0.95)):>8} {ms(h.max):>8}'
+
+        lines = [f'{"":<24} {"count":>7} {"p50 ms":>8} {"p95 ms":>8} {"max ms":>8}']
+
+        for name in ('event_loop_lag_seconds', 'db_query_seconds', 'db_transaction_seconds', 'db_commit_seconds'):
+            for _, h in metrics.family(name).items():
+                lines.append(f'{name.rsplit("_", 1)[0]:<24} {timings(h)}')
+
+        lines.append('')
+        commands = sorted(metrics.family('command_seconds').items(), key=lambda item: -item[1].count)
+        for labels, h in commands:
+            lines.append(f'{dict(labels)["command"]:<24} {timings(h)}')
+
+        errors = sum(c.value for labels, c in metrics.family('commands_total').items() if dict(labels)['outcome'] == 'error')
+        limited = sum(self.bot.rate_limiter.rejected.values())
+        outbox = self.bot.outbox.stats()
+
+        lines.append('')
+        lines.append(f'Command errors: {errors}, rate limited: {limited}')
+        lines.append(f'Outbox: {outbox["queued"]} queued, {outbox["sent"]} sent, {outbox["saved"]} saved')
+        lines.append(f'Gateway: {metrics.counter("gateway_ready_total").value} ready, {metrics.counter("gateway_resumed_total").value} resumed, '
+                     f'{metrics.counter("gateway_disconnects_total").value} disconnects')
+        lines.append(f'Code cache: {len(self.code_cache)} entries, {self.code_cache.hits} hits, {self.code_cache.misses} misses')
+
+        await ctx.send_paginated('\n'.join(lines), '```prolog\n')
+
+    @mod.command(name='profile', usage='profile <seconds> [slow callback threshold in ms]', description='Profile the bot and report slow callbacks')
+    @mod.is_owner()
+    @mod.concurrency_limit(1)
+    async def profile_cmd(self, ctx, seconds: float, threshold_ms: float = 50.0):
+        seconds = max(0.1, min(seconds, 300.0))
+        sampler, monitor = await profiler.profile(seconds, threshold_ms / 1000, bot=self.bot)
+
+        lines = [f'{sampler.samples} samples, {monitor.callbacks} callbacks, {sum(s[0] for s in monitor.slow.values())} took {threshold_ms:g} ms or longer']
+
+        for origin, count, total, longest in monitor.worst():
+            lines.append(f'{count:>5}x {total * 1000:>8.1f} ms total {longest * 1000:>8.1f} ms max  {origin}')
+
+        report = '\n'.join(lines)
+        if len(report) > 1900:
+            report = report[:1900] + '\n...'
 
+        await ctx.send(f'```prolog\n{report}```', file=discord.File(io.BytesIO(sampler.collapsed().encode()), 'profile.folded'))
 
     @mod.command(name='times', usage='times', description='Show uptime stats')
     async def times_cmd(self, ctx):
@@ -99,20 +326,21 @@ class CoreModule(mod.Module):
 
     @mod.group(name='superuser', invoke_without_command=True)
     @mod.is_owner()
+    @mod.rate_limit(3, 10)
     async def superuser_cmd(self, ctx):
         su_list = await asyncio.gather(*(self.bot.fetch_user(u) for u in self.bot.conf.superusers))
-        await ctx.send_paginated('Superusers:\n' + '\n'.join(f' - {su}' for su in su_list))
+        await ctx.send_paginated('Superusers:\n' + '\n'.join(f' - {su}' for su in su_list), coalesce=True)
 
     @superuser_cmd.command(name='add')
     @mod.is_owner()
     async def superuser_add_cmd(self, ctx, user: discord.User):
         self.bot.conf.superusers.add(user.id)
         await self.bot.conf.commit()
-        await ctx.send(f'Added {user} to superusers\n')
+        await ctx.send_coalesced(f'Added {user} to superusers\n')
 
     @superuser_cmd.command(name='remove')
     @mod.is_owner()
     async def superuser_remove_cmd(self, ctx, user: discord.User):
         self.bot.conf.superusers.discard(user.id)
         await self.bot.conf.commit()
-        await ctx.send(f'Removed {user} from superusers\n')
+        await ctx.send_coalesced(f'Removed {user} from superusers\n')
@@ -4,6 +4,13 @@ from ..common import *
 from .. import module as mod
 
 
+# Discord rejects embeds with a longer description (the API version discord.py 1.7 uses has the old limit)
+max_description = 2048
+
+# Cached renders for different bot identities (name, avatar and role colour can differ per guild)
+max_cached_renders = 64
+
+
 def cmd_str(c):
     return f'**{c.usage or c.name}**\n{c.description or "No description"}\n'
 
@@ -12,26 +19,75 @@ def cmd_str_debug(c):
     return f'**{c.usage or c.name}** [{", ".join(check.__qualname__.split(".", maxsplit=1)[0] for check in c.checks)}]\n{c.description or "No description"}\n'
 
 
+def split_description(parts, limit=max_description):
+    # Joins parts with new lines into as few strings of at most limit characters as possible.
+    # Parts are only split if they don't fit into a string by themselves.
+    page = []
+    size = 0
+
+    for part in parts:
+        for i in range(0, max(len(part), 1), limit):
+            chunk = part[i:i + limit]
+
+            if page and size + 1 + len(chunk) > limit:
+                yield '\n'.join(page)
+                page = []
+                size = 0
+
+            size += len(chunk) + (1 if page else 0)
+            page.append(chunk)
+
+    if page:
+        yield '\n'.join(page)
+
+
 class HelpModule(mod.Module):
-    @mod.command(name='help', usage='help', description='Show this message')
-    async def help_cmd(self, ctx):
-        commands = [c for c in ctx.bot.commands if not c.hidden]
-        commands.sort(key=lambda c: c.name)
-        commands.sort(key=lambda c: c.name != 'help')
+    def __init__(self, bot):
+        super().__init__(bot)
+
+        # (debug, name, avatar, colour) -> embeds, for the command set of _render_version
+        self._render_cache = {}
+        self._render_version = None
 
-        embed = Embed(colour=getattr(ctx.me, 'color', 0), description='\n'.join(cmd_str(c) for c in commands))
-        embed.set_author(name=ctx.me.name, icon_url=ctx.me.avatar_url)
+    def render(self, ctx, debug):
+        if self._render_version != self.bot.commands_version:
+            self._render_cache.clear()
+            self._render_version = self.bot.commands_version
 
-        await ctx.send(embed=embed)
+        colour = getattr(ctx.me, 'color', 0)
+        key = (debug, ctx.me.name, str(ctx.me.avatar_url), colour)
+
+        embeds = self._render_cache.get(key)
+        if embeds is not None:
+            return embeds
+
+        if debug:
+            commands = list(ctx.bot.commands)
+        else:
+            commands = [c for c in ctx.bot.commands if not c.hidden]
+
+        commands.sort(key=lambda c: (c.name != 'help', c.name))
+        fmt = cmd_str_debug if debug else cmd_str
+
+        descriptions = list(split_description(fmt(c) for c in commands)) or ['']
+        embeds = [Embed(colour=colour, description=description) for description in descriptions]
+        embeds[0].set_author(name=ctx.me.name, icon_url=ctx.me.avatar_url)
+
+        if len(self._render_cache) >= max_cached_renders:
+            self._render_cache.clear()
+
+        self._render_cache[key] = embeds
+        return embeds
+
+    @mod.command(name='help', usage='help', description='Show this message')
+    @mod.rate_limit(2, 10)
+    async def help_cmd(self, ctx):
+        for embed in self.render(ctx, debug=False):
+            await ctx.send(embed=embed)
 
     @mod.command(name='_help', hidden=True, usage='_help', description='Show debug information about all commands')
     @mod.is_owner()
+    @mod.rate_limit(1, 10)
     async def _help_cmd(self, ctx):
-        commands = [c for c in ctx.bot.commands]
-        commands.sort(key=lambda c: c.name)
-        commands.sort(key=lambda c: c.name != 'help')
-
-        embed = Embed(colour=getattr(ctx.me, 'color', 0), description='\n'.join(cmd_str_debug(c) for c in commands))
-        embed.set_author(name=ctx.me.name, icon_url=ctx.me.avatar_url)
-
-        await ctx.send(embed=embed)
+        for embed in self.render(ctx, debug=True):
+            await ctx.send(embed=embed)
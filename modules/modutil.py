@@ -6,7 +6,7 @@ class ModUtilModule(mod.Module):
     @mod.group(name='modules', hidden=True, invoke_without_command=True)
     @mod.is_owner()
     async def modules_cmd(self, ctx):
-        await ctx.send(f'```Loaded modules:\n{NEW_LINE.join(self.bot.modules)}```')
+        await ctx.send_coalesced(f'```Loaded modules:\n{NEW_LINE.join(self.bot.modules)}```')
 
     @modules_cmd.command(name='load')
     @mod.is_owner()
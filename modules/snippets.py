@@ -0,0 +1,133 @@
+import sys
+import marshal
+
+import gs6ex.module as mod
+from .core import clean_code, compile_payload
+
+
+class SnippetsModule(mod.Module):
+    # Named execc payloads, for snippets that are run often.
+    #
+    # Payloads are stored by their hash in the snippet_payloads table with their compiled code (marshalled),
+    # and the snippets table maps names to hashes. Snippets with the same payload share it.
+    # The compiled code is kept in core's code cache, keyed by the same hash like execc does. So running a snippet
+    # skips decoding, decompressing and compiling it, even right after a restart.
+    # Marshalled code only works with the python version it was made by, so it is recompiled after upgrades.
+
+    dependencies = ('core', )
+
+    async def on_load(self):
+        # name -> payload hash
+        self.hashes = dict(await self.bot.db.fetchall('SELECT name, hash FROM snippets;'))
+
+    @staticmethod
+    async def delete_unused(tx, key):
+        # Deletes a payload no snippet uses anymore
+        await tx.execute('DELETE FROM snippet_payloads WHERE hash = ? AND NOT EXISTS (SELECT 1 FROM snippets WHERE hash = ?);', (key, key))
+
+    @property
+    def code_cache(self):
+        return self.bot.modules['core'].code_cache
+
+    async def get_code(self, name):
+        key = self.hashes[name]
+
+        code = self.code_cache.get(key)
+        if code is not None:
+            return code
+
+        payload, data, cache_tag = await self.bot.db.fetchone('SELECT payload, code, cache_tag FROM snippet_payloads WHERE hash = ?;', (key, ))
+
+        if cache_tag == sys.implementation.cache_tag:
+            code = marshal.loads(data)
+
+        else:
+            self.log.info(f'Recompiling snippet {name!r} made by {cache_tag}')
+            code = compile_payload(payload)
+
+            async with self.bot.db.transaction() as tx:
+                await tx.execute('UPDATE snippet_payloads SET code = ?, cache_tag = ? WHERE hash = ?;', (marshal.dumps(code), sys.implementation.cache_tag, key))
+
+        self.code_cache.put(key, code)
+        return code
+
+    @mod.command(name='run', usage='run <name>', description='Run a saved snippet')
+    @mod.is_owner()
+    @mod.rate_limit(5, 10)
+    @mod.concurrency_limit(1, scope='user')
+    async def run_cmd(self, ctx, name: str):
+        if name not in self.hashes:
+            await ctx.add_success_reaction(False)
+            await ctx.send_coalesced(f'No snippet named {name!r}.')
+            return
+
+        await self.bot.modules['core'].run_compiled(ctx, await self.get_code(name))
+
+    @run_cmd.error
+    async def run_err(self, ctx, error):
+        if isinstance(error, mod.CheckFailure):
+            pass
+
+        else:
+            await ctx.send_paginated(error, coalesce=True)
+
+    @mod.group(name='snippet', invoke_without_command=True)
+    @mod.is_owner()
+    async def snippet_cmd(self, ctx):
+        await self.snippet_list_cmd(ctx)
+
+    @snippet_cmd.command(name='list')
+    @mod.is_owner()
+    async def snippet_list_cmd(self, ctx):
+        rows = await self.bot.db.fetchall('SELECT name, hash, length(payload) FROM snippets JOIN snippet_payloads USING (hash) ORDER BY name;')
+        cache = self.code_cache
+
+        lines = [f'{name:<24} {key.hex()[:12]} {size:>6} chars' for name, key, size in rows]
+        lines.append(f'\nCode cache: {len(cache)} entries, {cache.hits} hits, {cache.misses} misses')
+
+        await ctx.send_paginated('\n'.join(lines), '```prolog\n', coalesce=True)
+
+    @snippet_cmd.command(name='save', usage='snippet save <name> <payload>')
+    @mod.is_owner()
+    async def snippet_save_cmd(self, ctx, name: str, *, payload: str):
+        payload = clean_code(payload)
+
+        # Compiling it now also makes sure it is valid
+        try:
+            code = compile_payload(payload)
+
+        except Exception:
+            await ctx.add_success_reaction(False)
+            raise
+
+        key = self.code_cache.key(payload)
+        old_key = self.hashes.get(name)
+
+        async with self.bot.db.transaction() as tx:
+            await tx.execute(
+                'INSERT INTO snippet_payloads (hash, payload, code, cache_tag) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (hash) DO UPDATE SET code = excluded.code, cache_tag = excluded.cache_tag;',
+                (key, payload, marshal.dumps(code), sys.implementation.cache_tag))
+            await tx.execute('INSERT OR REPLACE INTO snippets (name, hash) VALUES (?, ?);', (name, key))
+
+            if old_key is not None and old_key != key:
+                await self.delete_unused(tx, old_key)
+
+        self.hashes[name] = key
+        self.code_cache.put(key, code)
+        await ctx.add_success_reaction(True)
+
+    @snippet_cmd.command(name='delete')
+    @mod.is_owner()
+    async def snippet_delete_cmd(self, ctx, name: str):
+        key = self.hashes.pop(name, None)
+        if key is None:
+            await ctx.add_success_reaction(False)
+            await ctx.send_coalesced(f'No snippet named {name!r}.')
+            return
+
+        async with self.bot.db.transaction() as tx:
+            await tx.execute('DELETE FROM snippets WHERE name = ?;', (name, ))
+            await self.delete_unused(tx, key)
+
+        await ctx.add_success_reaction(True)
@@ -1,19 +1,220 @@
-import os
-import subprocess as subp
-from shlex import quote
+import re
+import time
+import codecs
+import signal
+import asyncio
+import logging
+import collections
+from pathlib import Path
+
+import discord
 
 import gs6ex.module as mod
 
 
+log = logging.getLogger('bot.system')
+
+# The repository the bot runs from
+root = Path(__file__).resolve().parent.parent
+
+_line_end = re.compile(r'\r\n|\r|\n')
+
+
+async def run_process(*args, on_line=None, cwd=root):
+    # Runs a command without blocking the event loop. Every line of its output (stdout and stderr)
+    # is passed to on_line(line, replace) as it comes in, where replace is True if the previous line
+    # ended with a carriage return, which progress bars use to redraw their line.
+    # Returns the exit code and the output lines.
+    process = await asyncio.create_subprocess_exec(
+        *args, cwd=cwd, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+
+    lines = []
+    buffer = ''
+    replace = False
+
+    # Keeps the start of a character that was split between chunks until the rest of it comes in
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    while chunk := await process.stdout.read(4096):
+        buffer += decoder.decode(chunk)
+        start = 0
+
+        for match in _line_end.finditer(buffer):
+            line = buffer[start:match.start()]
+            start = match.end()
+
+            if line:
+                lines.append(line)
+                if on_line is not None:
+                    on_line(line, replace)
+
+            replace = match.group() == '\r'
+
+        buffer = buffer[start:]
+
+    buffer += decoder.decode(b'', final=True)
+    if buffer:
+        lines.append(buffer)
+        if on_line is not None:
+            on_line(buffer, replace)
+
+    return await process.wait(), lines
+
+
+async def git_output(*args, cwd=root):
+    code, lines = await run_process('git', *args, cwd=cwd)
+    if code:
+        raise RuntimeError(f'git {" ".join(args)} failed with exit code {code}:\n' + '\n'.join(lines))
+
+    return lines
+
+
+class ProgressMessage:
+    # A message showing the last lines of some output, edited at most every interval seconds while it comes in
+
+    def __init__(self, channel, title, *, max_lines=15, interval=1.0):
+        self.channel = channel
+        self.title = title
+        self.status = 'running'
+        self.interval = interval
+
+        self.lines = collections.deque(maxlen=max_lines)
+        self._dirty = False
+        self._message = None
+        self._task = None
+
+    def add(self, line, replace=False):
+        if replace and self.lines:
+            self.lines.pop()
+
+        self.lines.append(line[:200])
+        self._dirty = True
+
+    def render(self):
+        body = '\n'.join(self.lines)[-1800:]
+        return f'{self.title} ({self.status})\n```\n{body or " "}\n```'
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            if self._dirty:
+                self._dirty = False
+                await self._edit()
+
+    async def _edit(self):
+        try:
+            await self._message.edit(content=self.render())
+
+        except discord.HTTPException:
+            log.warning('Could not update progress message', exc_info=True)
+
+    async def __aenter__(self):
+        self._message = await self.channel.send(self.render())
+        self._task = asyncio.create_task(self._refresh())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._task.cancel()
+
+        if self.status == 'running':
+            self.status = 'failed' if exc_type else 'done'
+
+        await self._edit()
+
+
+def _parse_submodules(lines):
+    # git submodule status lines -> {path: commit}, for the submodules that are checked out
+    submodules = {}
+    for line in lines:
+        commit, path = line[1:].split()[:2]
+        if line[0] != '-':
+            submodules[path] = commit
+
+    return submodules
+
+
 class SystemModule(mod.Module):
     class Config(mod.Config):
         systemd_service_name: str = 'gs6ex'
+        # How many submodules are fetched at the same time
+        fetch_concurrency: int = 4
+
+    async def git(self, progress, *args, cwd=root, prefix=''):
+        code, _ = await run_process('git', *args, cwd=cwd, on_line=lambda line, replace: progress.add(prefix + line, replace))
+        if code:
+            raise RuntimeError(f'{prefix}git {args[0]} failed with exit code {code}')
+
+    async def fetch_submodules(self, progress, paths):
+        limit = asyncio.Semaphore(self.conf.fetch_concurrency)
+
+        async def fetch(path):
+            async with limit:
+                await self.git(progress, 'fetch', '--progress', cwd=root / path, prefix=f'{path}: ')
+
+        await asyncio.gather(*(fetch(path) for path in paths))
+
+    async def changed_files(self, old_head, old_submodules):
+        # Paths of the files that changed since old_head, including those in submodules
+        new_head, = await git_output('rev-parse', 'HEAD')
+        files = await git_output('diff', '--name-only', old_head, new_head) if new_head != old_head else []
+
+        submodules = _parse_submodules(await git_output('submodule', 'status', '--recursive'))
+        for path, commit in submodules.items():
+            # New submodules are in the diff already
+            old_commit = old_submodules.get(path)
+
+            if old_commit is not None and old_commit != commit:
+                files.extend(f'{path}/{f}' for f in await git_output('diff', '--name-only', old_commit, commit, cwd=root / path))
+
+        return files
 
     @mod.command(name='update', hidden=True)
     @mod.is_owner()
+    @mod.concurrency_limit(1)
     async def update_cmd(self, ctx):
-        failure = subp.call(['git', 'pull']) or subp.call(['git', 'submodule', 'update', '--recursive', '--remote'])
-        await ctx.add_success_reaction(not failure)
+        # Pulls, fetches the submodules in parallel, checks them out, and then reloads the modules whose files changed
+        start = time.perf_counter()
+
+        try:
+            async with ProgressMessage(ctx.channel, 'Updating') as progress:
+                old_head, = await git_output('rev-parse', 'HEAD')
+                old_submodules = _parse_submodules(await git_output('submodule', 'status', '--recursive'))
+
+                await self.git(progress, 'pull', '--progress')
+
+                # The pull may have added submodules, which get cloned by the update
+                submodules = _parse_submodules(await git_output('submodule', 'status', '--recursive'))
+                await self.fetch_submodules(progress, submodules)
+                await self.git(progress, 'submodule', 'update', '--init', '--recursive', '--remote', '--no-fetch')
+
+                files = await self.changed_files(old_head, old_submodules)
+
+                # The modules using the files the update changed. Of their files, the reloader only runs the ones whose content differs.
+                names = sorted(name for name in mod.modules_using_files(root / f for f in files) if name in self.bot.modules)
+                errors = await self.bot.load_modules(names, persistent=False) if names else {}
+
+                progress.status = f'done in {time.perf_counter() - start:.1f} s'
+
+        except Exception:
+            await ctx.add_success_reaction(False)
+            raise
+
+        # Code outside the modules folder can only be updated by restarting
+        core_files = [f for f in files if f.endswith('.py') and not f.startswith(('modules/', 'benchmarks/'))]
+
+        lines = [f'Files changed: {len(files)}.']
+        if names:
+            lines.append(f'Reloaded {", ".join(n for n in names if n not in errors) or "nothing"}.')
+
+        if errors:
+            lines.append(f'Failed to reload {", ".join(errors)}.')
+
+        if core_files:
+            lines.append(f'Restart to apply changes to {", ".join(core_files)}.')
+
+        await ctx.send_coalesced('\n'.join(lines))
+        await ctx.add_success_reaction(not errors)
 
     @mod.command(name='restart', hidden=True)
     @mod.is_owner()
@@ -24,11 +225,14 @@ class SystemModule(mod.Module):
             await ctx.add_success_reaction(False)
 
         else:
-            # Normally, using os.system is not a good idea.
-            # I think it's fine in this case because we don't
-            # have any user controlled data and the command shuts down
-            # the program anyway.
-            # I tried using subprocess here, but it didn't work.
-            # ~hmry (2019-10-21, 02:12)
             systemd_name = f'{service}@{self.bot.profile_name}'
-            os.system(f'systemctl --user restart {quote(systemd_name)}')
+
+            # Lets the next process resume our gateway session instead of identifying, see session.py
+            self.bot.hand_off_on_close = True
+
+            # systemctl runs in the service's cgroup, so stopping the service kills it too, before it could return.
+            # With --no-block, it only queues the restart and returns. If it's killed anyway, the restart is underway.
+            code, _ = await run_process('systemctl', '--user', '--no-block', 'restart', systemd_name)
+            if code not in (0, -signal.SIGTERM):
+                self.bot.hand_off_on_close = False
+                await ctx.add_success_reaction(False)
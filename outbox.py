@@ -0,0 +1,101 @@
+import asyncio
+
+
+class _ChannelQueue:
+    __slots__ = ('pending', 'task')
+
+    def __init__(self):
+        # [(content, future)]
+        self.pending = []
+        self.task = None
+
+
+class Outbox:
+    # Merges short text messages the bot sends to the same channel in quick succession into one message.
+    # Each channel has a queue that is drained by one task, so sends to a channel happen one at a time.
+    # While a send is waiting for the channel's rate limit bucket (discord.py handles that in its HTTP client),
+    # new messages pile up in the queue and go out together with the next send.
+    # So the busier a channel gets, the more gets merged, and a burst uses a few requests instead of one each.
+
+    def __init__(self, *, window=0.2, max_size=2000):
+        self.window = window
+        self.max_size = max_size
+
+        # channel id -> _ChannelQueue, only while there is something to send
+        self._channels = {}
+
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'saved': self.queued - self.sent - self.failed,
+            'failed': self.failed,
+            'channels': len(self._channels),
+        }
+
+    def send(self, channel, content):
+        # Returns a future for the message the content ended up in
+        content = str(content)
+        future = asyncio.get_running_loop().create_future()
+
+        queue = self._channels.get(channel.id)
+        if queue is None:
+            queue = self._channels[channel.id] = _ChannelQueue()
+            queue.task = asyncio.create_task(self._drain(channel, queue))
+
+        queue.pending.append((content, future))
+        self.queued += 1
+        return future
+
+    def _take_batch(self, queue):
+        # Takes as many messages from the front of the queue as fit into one message
+        pending = queue.pending
+        size = len(pending[0][0])
+        count = 1
+
+        while count < len(pending) and size + 1 + len(pending[count][0]) <= self.max_size:
+            size += 1 + len(pending[count][0])
+            count += 1
+
+        batch = pending[:count]
+        del pending[:count]
+        return batch
+
+    async def _drain(self, channel, queue):
+        try:
+            # Give the rest of a burst a moment to arrive
+            await asyncio.sleep(self.window)
+
+            while queue.pending:
+                batch = self._take_batch(queue)
+
+                try:
+                    message = await channel.send('\n'.join(content for content, _ in batch))
+
+                except Exception as e:
+                    self.failed += len(batch)
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+
+                else:
+                    self.sent += 1
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(message)
+
+        finally:
+            del self._channels[channel.id]
+
+            # Only reached with messages left if we were cancelled
+            for _, future in queue.pending:
+                future.cancel()
+
+    async def flush(self):
+        # Waits until everything queued so far has been sent
+        tasks = [queue.task for queue in self._channels.values()]
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,188 @@
+import sys
+import time
+import asyncio
+import inspect
+import threading
+import collections
+from pathlib import Path
+
+
+# Tools for finding out why the bot is slow or stalling, used by the profile command.
+#
+# StackSampler looks at the event loop thread's stack from a background thread every few milliseconds,
+# and counts how often each stack was seen. The result is in the collapsed stack format that
+# flamegraph.pl, speedscope and similar tools read.
+#
+# SlowCallbackMonitor times every callback the event loop runs (by wrapping asyncio's Handle._run,
+# only while it is active, and only for the loop it was entered on), and records the ones that took
+# longer than a threshold.
+# asyncio's own slow callback warnings need debug mode, which slows everything else down too.
+
+
+# Coroutines in here (like asyncio.sleep) are never the interesting part
+_asyncio_dir = str(Path(asyncio.__file__).parent)
+
+# code object -> frame name in collapsed stacks
+_frame_names = {}
+
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        qualname = getattr(code, 'co_qualname', code.co_name)
+        name = _frame_names[code] = f'{qualname} ({Path(code.co_filename).name}:{code.co_firstlineno})'
+
+    return name
+
+
+class StackSampler:
+    def __init__(self, thread_id, interval=0.005):
+        self.thread_id = thread_id
+        self.interval = interval
+
+        # collapsed stack (outermost frame first) -> number of samples
+        self.stacks = collections.Counter()
+        self.samples = 0
+
+    def sample(self, duration):
+        # Blocks for duration seconds, run it in a separate thread
+        end = time.perf_counter() + duration
+
+        while time.perf_counter() < end:
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is not None:
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+
+                self.stacks[';'.join(reversed(names))] += 1
+                self.samples += 1
+
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class SlowCallbackMonitor:
+    def __init__(self, threshold, bot=None):
+        self.threshold = threshold
+        self.callbacks = 0
+
+        # origin -> [count, total seconds, max seconds]
+        self.slow = {}
+
+        # Command callbacks and module files, to tell which command or module a slow callback came from
+        self._commands = {}
+        self._module_files = {}
+
+        if bot is not None:
+            for command in bot.walk_commands():
+                self._commands[command.callback.__code__] = command.qualified_name
+
+            for name, instance in bot.modules.items():
+                self._module_files[inspect.getfile(type(instance))] = name
+
+        self._original_run = None
+
+    @staticmethod
+    def _chain(handle):
+        # The coroutines awaiting each other in the task a callback steps, from the task's down to where it is
+        # suspended. Taken before the step runs: afterwards, it's suspended in whatever it awaited next.
+        task = getattr(handle._callback, '__self__', None)
+        if not isinstance(task, asyncio.Task):
+            return None
+
+        chain = []
+        coro = task.get_coro()
+
+        while coro is not None:
+            code = getattr(coro, 'cr_code', None) or getattr(coro, 'gi_code', None)
+            if code is None:
+                break
+
+            chain.append((coro, code))
+            coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+
+        return chain
+
+    def _origin(self, handle, chain):
+        if not chain:
+            callback = handle._callback
+            return getattr(callback, '__qualname__', repr(callback))
+
+        # The innermost command callback or module function in the chain is what we blame
+        description = getattr(chain[0][0], '__qualname__', repr(chain[0][0]))
+        innermost = None
+        origin = None
+
+        for coro, code in chain:
+            if not code.co_filename.startswith(_asyncio_dir):
+                innermost = getattr(coro, '__qualname__', None)
+
+            if code in self._commands:
+                origin = f'command {self._commands[code]!r}'
+
+            elif code.co_filename in self._module_files and origin is None:
+                origin = f'module {self._module_files[code.co_filename]!r}'
+
+        if innermost and innermost != description:
+            description = f'{description} > {innermost}'
+
+        return f'{description} ({origin})' if origin else description
+
+    def __enter__(self):
+        # asyncio has no per loop hook for this, so the wrapper passes the callbacks of other loops straight through
+        original_run = self._original_run = asyncio.events.Handle._run
+        loop = asyncio.get_running_loop()
+        monitor = self
+
+        def _run(handle):
+            if handle._loop is not loop:
+                return original_run(handle)
+
+            chain = monitor._chain(handle)
+            start = time.perf_counter()
+            original_run(handle)
+            elapsed = time.perf_counter() - start
+
+            monitor.callbacks += 1
+            if elapsed >= monitor.threshold:
+                monitor._record(handle, chain, elapsed)
+
+        asyncio.events.Handle._run = _run
+        return self
+
+    def __exit__(self, *exc_info):
+        asyncio.events.Handle._run = self._original_run
+
+    def _record(self, handle, chain, elapsed):
+        try:
+            origin = self._origin(handle, chain)
+
+        except Exception as e:
+            origin = f'<unknown: {e!r}>'
+
+        stats = self.slow.get(origin)
+        if stats is None:
+            stats = self.slow[origin] = [0, 0.0, 0.0]
+
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+
+    def worst(self, n=10):
+        # [(origin, count, total seconds, max seconds)], by total time
+        return sorted(((origin, *stats) for origin, stats in self.slow.items()), key=lambda item: -item[2])[:n]
+
+
+async def profile(duration, threshold, *, bot=None, interval=0.005):
+    # Samples the event loop thread for duration seconds while monitoring slow callbacks.
+    # Returns the StackSampler and SlowCallbackMonitor.
+    sampler = StackSampler(threading.get_ident(), interval)
+
+    with SlowCallbackMonitor(threshold, bot) as monitor:
+        await asyncio.get_running_loop().run_in_executor(None, sampler.sample, duration)
+
+    return sampler, monitor
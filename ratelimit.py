@@ -0,0 +1,179 @@
+import time
+import collections
+
+
+# Per-command rate and concurrency limits, declared with mod.rate_limit and mod.concurrency_limit.
+# They are enforced by Gs6Ex.invoke after the command's checks and before the command is prepared.
+# So invocations that fail the checks don't use up the limits of those that pass, and a rejected
+# invocation costs the checks and a couple of dict lookups: no argument conversion, no reply.
+#
+# Limits only apply to the command they are declared on. A limit on a group counts invocations of the
+# group by itself, not of its subcommands, which have limits of their own.
+
+
+def _scope_key(scope, ctx):
+    if scope == 'user':
+        return ctx.author.id
+
+    if scope == 'channel':
+        return ctx.channel.id
+
+    if scope == 'guild':
+        # DMs count as their own guild
+        return ctx.guild.id if ctx.guild is not None else ctx.channel.id
+
+    return None
+
+
+class Limit:
+    scopes = ('user', 'channel', 'guild', 'global')
+
+    def __init__(self, scope):
+        if scope not in self.scopes:
+            raise ValueError(f'scope must be one of {self.scopes}, not {scope!r}')
+
+        self.scope = scope
+
+
+class RateLimit(Limit):
+    # Token bucket: allows burst invocations at once, refilling at rate invocations per per seconds
+    def __init__(self, rate, per, *, scope='user', burst=None):
+        super().__init__(scope)
+        self.capacity = burst if burst is not None else rate
+        self.refill = rate / per
+
+        # An idle bucket is full again after this long, and can then be forgotten
+        self.idle_after = self.capacity / self.refill
+
+    def __repr__(self):
+        return f'<RateLimit {self.refill * 60:g}/min burst={self.capacity} per {self.scope}>'
+
+
+class ConcurrencyLimit(Limit):
+    # At most number invocations running at once
+    def __init__(self, number, *, scope='global'):
+        super().__init__(scope)
+        self.number = number
+
+    def __repr__(self):
+        return f'<ConcurrencyLimit {self.number} per {self.scope}>'
+
+
+def add_limit(func, limit):
+    # Limits are stored on the callback, since commands are copied for every module instance
+    callback = getattr(func, 'callback', func)
+
+    if not hasattr(callback, '__gs6ex_limits__'):
+        callback.__gs6ex_limits__ = []
+
+    callback.__gs6ex_limits__.append(limit)
+    return func
+
+
+def get_limits(command):
+    return getattr(command.callback, '__gs6ex_limits__', ())
+
+
+def _release_nothing():
+    pass
+
+
+class RateLimiter:
+    def __init__(self):
+        # (command name, limit index) -> (idle after, {scope key: [tokens, last update]})
+        # The buckets of a limit are ordered by last use. They all become idle after the same time,
+        # so the least recently used ones are the first to be idle, and can be evicted from the front.
+        self._buckets = {}
+
+        # (command name, limit index, scope key) -> invocations in flight
+        self._in_flight = {}
+
+        self.rejected = collections.Counter()
+
+    def __len__(self):
+        return sum(len(buckets) for _, buckets in self._buckets.values()) + len(self._in_flight)
+
+    def acquire(self, ctx, command):
+        # Returns a function to call when the invocation of command is done, or None if it was rejected
+        limits = get_limits(command)
+        if not limits:
+            return _release_nothing
+
+        name = command.qualified_name
+        now = time.monotonic()
+
+        # Check everything before taking anything, so a rejection doesn't use up tokens
+        rate_limited = []
+        concurrency_limited = []
+
+        for i, limit in enumerate(limits):
+            key = (name, i, _scope_key(limit.scope, ctx))
+
+            if isinstance(limit, RateLimit):
+                entry = self._buckets.get(key[:2])
+                if entry is None:
+                    entry = self._buckets[key[:2]] = (limit.idle_after, {})
+
+                buckets = entry[1]
+                bucket = buckets.pop(key[2], None)
+                if bucket is None:
+                    bucket = [limit.capacity, now]
+
+                else:
+                    bucket[0] = min(limit.capacity, bucket[0] + (now - bucket[1]) * limit.refill)
+                    bucket[1] = now
+
+                # Reinsert at the end, it's the most recently used one now
+                buckets[key[2]] = bucket
+
+                if bucket[0] < 1:
+                    self._reject(name, now)
+                    return None
+
+                rate_limited.append(bucket)
+
+            else:
+                if self._in_flight.get(key, 0) >= limit.number:
+                    self._reject(name, now)
+                    return None
+
+                concurrency_limited.append(key)
+
+        for bucket in rate_limited:
+            bucket[0] -= 1
+
+        for key in concurrency_limited:
+            self._in_flight[key] = self._in_flight.get(key, 0) + 1
+
+        self._evict(now)
+
+        if not concurrency_limited:
+            return _release_nothing
+
+        def release():
+            for key in concurrency_limited:
+                if self._in_flight[key] <= 1:
+                    del self._in_flight[key]
+
+                else:
+                    self._in_flight[key] -= 1
+
+        return release
+
+    def _reject(self, name, now):
+        self.rejected[name] += 1
+        self._evict(now)
+
+    def _evict(self, now):
+        # Forget buckets that have been idle long enough to be full again.
+        # A full bucket behaves exactly like a new one, so this doesn't change any results.
+        # For each limit, only the least recently used buckets are looked at, up to the first one still in use.
+        # Its idle time is the same for all of its buckets, so none behind that one can be idle yet.
+        # So this is amortized constant time per limit, and the buckets stay bounded by the recently active keys.
+        for idle_after, buckets in self._buckets.values():
+            while buckets:
+                key = next(iter(buckets))
+                if now - buckets[key][1] < idle_after:
+                    break
+
+                del buckets[key]
@@ -0,0 +1,238 @@
+import os
+import ast
+import sys
+import hashlib
+import graphlib
+import importlib
+import logging
+
+
+log = logging.getLogger('bot')
+
+
+def _package_of(py_module):
+    if hasattr(py_module, '__path__'):
+        return py_module.__name__
+
+    return py_module.__name__.rpartition('.')[0]
+
+
+def find_imports(py_module, source):
+    # Absolute names of everything a python module imports (or might, for from ... import name).
+    # Imports inside functions count too, since they run against whatever is in sys.modules.
+    package = _package_of(py_module)
+    imports = set()
+
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            imports.update(alias.name for alias in node.names)
+
+        elif isinstance(node, ast.ImportFrom):
+            if node.level:
+                base = package.rsplit('.', node.level - 1)[0] if node.level > 1 else package
+                base = f'{base}.{node.module}' if node.module else base
+
+            else:
+                base = node.module
+
+            imports.add(base)
+            imports.update(f'{base}.{alias.name}' for alias in node.names)
+
+    return imports
+
+
+class _Source:
+    __slots__ = ('mtime', 'digest', 'imports', 'generation')
+
+    def __init__(self, mtime, digest, imports, generation):
+        self.mtime = mtime
+        self.digest = digest
+        self.imports = imports
+        self.generation = generation
+
+
+class Reloader:
+    # Reloads the python modules under a package (the modules folder) when their source changes.
+    #
+    # For every python module under the package that has been imported, we remember the modification
+    # time and hash of its source and what it imports. When one is requested, the changed python modules
+    # it imports (directly or indirectly) are reloaded along with everything between them and it, dependencies
+    # first. So changes to helper files are picked up too, unchanged files aren't re-executed, and a broken
+    # file only affects the modules that use it.
+    # A file counts as changed if its mtime differs and its hash does too, so touching a file is free.
+    #
+    # Each reload runs the code into a new python module object. If any of them fails, the previous objects
+    # are put back, so nothing is left half reloaded and the next request tries again.
+    # Python modules that weren't requested but use a reloaded one are stale afterwards (see stale()), since
+    # they still hold the old version. The generation of a python module is the reload it was last run in.
+
+    def __init__(self, package):
+        self.prefix = package + '.'
+
+        # python module name -> _Source
+        self._sources = {}
+        self._generation = 0
+
+    def _path(self, name):
+        return getattr(sys.modules.get(name), '__file__', None)
+
+    def _read(self, name):
+        # Returns (mtime, source bytes), or None if the module has no source file (anymore)
+        path = self._path(name)
+        if path is None:
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                return os.fstat(f.fileno()).st_mtime_ns, f.read()
+
+        except OSError:
+            return None
+
+    def _record(self, name):
+        result = self._read(name)
+        if result is None:
+            self._sources.pop(name, None)
+            return
+
+        mtime, source = result
+
+        try:
+            imports = {i for i in find_imports(sys.modules[name], source) if i.startswith(self.prefix)}
+
+        except SyntaxError:
+            imports = set()
+
+        self._sources[name] = _Source(mtime, hashlib.blake2b(source).digest(), imports, self._generation)
+
+    def _changed(self, name):
+        source = self._sources[name]
+        path = self._path(name)
+
+        try:
+            if os.stat(path).st_mtime_ns == source.mtime:
+                return False
+
+        except (OSError, TypeError):
+            # Deleted files can't be reloaded
+            return False
+
+        result = self._read(name)
+        if result is None:
+            return False
+
+        mtime, data = result
+        if hashlib.blake2b(data).digest() != source.digest:
+            return True
+
+        # Only touched, so next time the mtime check is enough
+        source.mtime = mtime
+        return False
+
+    def _uses_reloaded(self, name):
+        # Whether something name imports was reloaded after name was last run
+        source = self._sources[name]
+        return any(self._sources[i].generation > source.generation for i in source.imports if i in self._sources)
+
+    def _track_new(self):
+        for name in list(sys.modules):
+            if name.startswith(self.prefix) and name not in self._sources:
+                self._record(name)
+
+    def _with_importers(self, names):
+        # names plus everything importing them, directly or indirectly
+        importers = {}
+        for n, source in self._sources.items():
+            for i in source.imports:
+                importers.setdefault(i, set()).add(n)
+
+        result = set()
+        pending = list(names)
+        while pending:
+            n = pending.pop()
+            if n not in result and n in sys.modules:
+                result.add(n)
+                pending.extend(importers.get(n, ()))
+
+        return result
+
+    def _imported_by(self, name):
+        # name plus the python modules under the package it imports, directly or indirectly
+        result = set()
+        pending = [name]
+        while pending:
+            n = pending.pop()
+            if n not in result and n in self._sources:
+                result.add(n)
+                pending.extend(self._sources[n].imports)
+
+        return result
+
+    def outdated(self):
+        # Names of the python modules that have to be reloaded: the changed ones, the ones still using the old
+        # version of a reloaded one, and everything importing those (directly or indirectly).
+        self._track_new()
+        return self._with_importers(n for n in self._sources if n in sys.modules and (self._changed(n) or self._uses_reloaded(n)))
+
+    def importers_of_files(self, paths):
+        # Names of the python modules whose source is one of the files in paths, and everything importing them
+        self._track_new()
+        paths = {os.path.realpath(path) for path in paths}
+        return self._with_importers(n for n in self._sources if self._path(n) is not None and os.path.realpath(self._path(n)) in paths)
+
+    def stale(self):
+        # Names of the python modules that still use the old version of a reloaded one, directly or indirectly
+        self._track_new()
+        return self._with_importers(n for n in self._sources if n in sys.modules and self._uses_reloaded(n))
+
+    def _reload(self, order):
+        previous = {}
+
+        try:
+            for n in order:
+                previous[n] = sys.modules.pop(n)
+                importlib.import_module(n)
+
+        except BaseException:
+            for n, py_module in previous.items():
+                sys.modules[n] = py_module
+
+                # Importing set the new python module as an attribute of its package
+                package, _, attr = n.rpartition('.')
+                setattr(sys.modules[package], attr, py_module)
+
+            raise
+
+        self._generation += 1
+        for n in order:
+            self._record(n)
+
+    def import_module(self, name):
+        # Imports (or reloads, if needed) the python module name, relative to the package.
+        # Returns it, plus the names of all python modules that were reloaded.
+        full_name = self.prefix + name
+
+        if full_name not in sys.modules:
+            py_module = importlib.import_module(full_name)
+            self._track_new()
+            return py_module, []
+
+        to_reload = self.outdated() & self._imported_by(full_name)
+        if not to_reload:
+            return sys.modules[full_name], []
+
+        graph = {n: self._sources[n].imports & to_reload for n in to_reload}
+
+        try:
+            order = list(graphlib.TopologicalSorter(graph).static_order())
+
+        except graphlib.CycleError:
+            log.warning(f'Import cycle among {", ".join(sorted(to_reload))}, reloading in arbitrary order')
+            order = list(to_reload)
+
+        self._reload(order)
+
+        # Reloading may have imported new helpers
+        self._track_new()
+
+        return sys.modules[full_name], order
@@ -0,0 +1,444 @@
+import time
+import heapq
+import pickle
+import random
+import asyncio
+import inspect
+import logging
+import itertools
+
+
+log = logging.getLogger('bot')
+
+
+# A single, bot-wide timer heap for Module.schedule_task.
+# Pending jobs are just heap entries, so they don't cost a task, coroutine frame and timer handle each.
+# One dispatcher task sleeps until the earliest job is due, and only then starts it as a task.
+
+
+class ScheduledJob:
+    # Handle for a scheduled job, returned by Scheduler.schedule
+
+    __slots__ = ('when', 'func', 'args', 'owner', '_scheduler', '_cancelled', '_task')
+
+    def __init__(self, scheduler, when, func, args, owner):
+        self.when = when
+        self.func = func
+        self.args = args
+        self.owner = owner
+        self._scheduler = scheduler
+        self._cancelled = False
+        self._task = None
+
+    def cancel(self):
+        # Returns False if the job has already finished
+        if self._cancelled:
+            return True
+
+        if self._task is not None:
+            return self._task.cancel()
+
+        self._cancelled = True
+        self._scheduler._cancelled_count += 1
+
+        # Don't warn about a coroutine that was never awaited
+        if inspect.iscoroutine(self.func):
+            self.func.close()
+
+        return True
+
+    def cancelled(self):
+        return self._cancelled or (self._task is not None and self._task.cancelled())
+
+    def done(self):
+        return self._cancelled or (self._task is not None and self._task.done())
+
+    def __repr__(self):
+        name = getattr(self.func, '__qualname__', repr(self.func))
+        return f'<ScheduledJob {name} when={self.when:.3f}{" cancelled" if self.cancelled() else ""}>'
+
+
+class Scheduler:
+    # Cancelled jobs stay in the heap until they come up, unless they make up more than
+    # half of it, in which case the heap is rebuilt without them.
+    compact_threshold = 1024
+
+    def __init__(self):
+        # (loop time, sequence number, job). The sequence number keeps jobs due at the same time in order.
+        self._heap = []
+        self._sequence = itertools.count()
+        self._cancelled_count = 0
+        self._running = set()
+
+        self._dispatcher = None
+        self._wakeup = None
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled_count
+
+    def schedule(self, when, func, *args, owner=None):
+        # func is either a coroutine function, which is called with args once the job is due,
+        # or a coroutine object (in which case there can't be any args).
+        # when is in loop time, see schedule_in.
+        if inspect.iscoroutine(func) and args:
+            raise TypeError('Can not pass arguments along with a coroutine object')
+
+        job = ScheduledJob(self, when, func, args, owner)
+        heapq.heappush(self._heap, (when, next(self._sequence), job))
+
+        if self._dispatcher is None:
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+        elif self._heap[0][2] is job:
+            # The dispatcher is waiting for a later job
+            self._wake()
+
+        return job
+
+    def schedule_in(self, delay, func, *args, owner=None):
+        return self.schedule(asyncio.get_running_loop().time() + delay, func, *args, owner=owner)
+
+    def cancel_owner(self, owner):
+        # Cancels all pending and running jobs of owner, returns how many were cancelled
+        count = 0
+
+        for _, _, job in self._heap:
+            if job.owner is owner and not job._cancelled:
+                job.cancel()
+                count += 1
+
+        for job in list(self._running):
+            if job.owner is owner:
+                job.cancel()
+                count += 1
+
+        self._maybe_compact()
+        return count
+
+    def close(self):
+        for _, _, job in self._heap:
+            job.cancel()
+
+        for job in list(self._running):
+            job.cancel()
+
+        self._heap.clear()
+        self._cancelled_count = 0
+
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            self._dispatcher = None
+
+    def _wake(self):
+        if self._wakeup is not None and not self._wakeup.done():
+            self._wakeup.set_result(None)
+
+    def _maybe_compact(self):
+        if self._cancelled_count > self.compact_threshold and self._cancelled_count * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if not entry[2]._cancelled]
+            heapq.heapify(self._heap)
+            self._cancelled_count = 0
+
+    async def _dispatch(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            heap = self._heap
+            now = loop.time()
+
+            while heap and heap[0][0] <= now:
+                _, _, job = heapq.heappop(heap)
+
+                if job._cancelled:
+                    self._cancelled_count -= 1
+
+                else:
+                    # Nothing a job does may stop the dispatcher, or no other job would run anymore
+                    try:
+                        self._start(job)
+
+                    except Exception:
+                        owner_log = getattr(job.owner, 'log', log)
+                        owner_log.error('Could not start scheduled task:', exc_info=True)
+
+            self._maybe_compact()
+            heap = self._heap
+
+            self._wakeup = loop.create_future()
+            timer = loop.call_at(heap[0][0], self._wake) if heap else None
+
+            try:
+                await self._wakeup
+
+            finally:
+                self._wakeup = None
+                if timer is not None:
+                    timer.cancel()
+
+    def _start(self, job):
+        job._task = asyncio.create_task(self._run(job))
+        self._running.add(job)
+
+    async def _run(self, job):
+        # The job is only called here, inside the task, so exceptions it raises synchronously
+        # (like a TypeError for the wrong arguments) end up in the log too
+        try:
+            await (job.func if inspect.iscoroutine(job.func) else job.func(*job.args))
+
+        except asyncio.CancelledError:
+            raise
+
+        except Exception:
+            owner_log = getattr(job.owner, 'log', log)
+            owner_log.error('Exception in scheduled task:', exc_info=True)
+
+        finally:
+            self._running.discard(job)
+
+
+class RepeatedJob:
+    # Handle for Module.schedule_repeated, which also keeps statistics about the runs.
+    #
+    # In fixed rate mode, runs are due at start + n * period on the loop's monotonic clock,
+    # no matter how long each run takes, so the schedule doesn't drift.
+    # In fixed delay mode, the next run is due one period after the previous one finished.
+    #
+    # Runs never overlap. If a run takes longer than a period, the ticks that passed in the meantime
+    # are handled according to missed:
+    #   'skip'     - drop them, and wait for the next tick
+    #   'coalesce' - run once right away, then continue with the next tick
+    #   'burst'    - run once for every missed tick, back to back, until caught up
+    #
+    # jitter (in seconds) shifts the whole schedule by a random amount, so jobs with the same period
+    # that were scheduled at the same time (e.g. at startup) don't all run at once.
+
+    missed_policies = ('skip', 'coalesce', 'burst')
+
+    def __init__(self, scheduler, func, args, period, *, fixed_rate=True, missed='coalesce', jitter=0, owner=None):
+        if period <= 0:
+            raise ValueError('Period must be positive')
+
+        if missed not in self.missed_policies:
+            raise ValueError(f'missed must be one of {self.missed_policies}, not {missed!r}')
+
+        self.func = func
+        self.args = args
+        self.period = period
+        self.fixed_rate = fixed_rate
+        self.missed = missed
+        self.owner = owner
+
+        self.runs = 0
+        self.failures = 0
+        self.skipped = 0
+        self.last_runtime = None
+        self.max_runtime = 0
+        self.total_runtime = 0
+        self.last_lag = None
+        self.max_lag = 0
+
+        self._scheduler = scheduler
+        self._cancelled = False
+        self._current = None
+
+        self._start = asyncio.get_running_loop().time() + random.uniform(0, jitter)
+        self._tick = 0
+        self._schedule(self._start)
+
+    def cancel(self):
+        self._cancelled = True
+        if self._current is not None:
+            self._current.cancel()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def stats(self):
+        return {
+            'runs': self.runs,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'last_runtime': self.last_runtime,
+            'mean_runtime': self.total_runtime / self.runs if self.runs else None,
+            'max_runtime': self.max_runtime,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+        }
+
+    def _schedule(self, due):
+        self._due = due
+        self._current = self._scheduler.schedule(due, self._run, owner=self.owner)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        self.last_lag = started - self._due
+        self.max_lag = max(self.max_lag, self.last_lag)
+
+        try:
+            await self.func(*self.args)
+
+        except asyncio.CancelledError:
+            self._cancelled = True
+            raise
+
+        except Exception:
+            self.failures += 1
+            owner_log = getattr(self.owner, 'log', log)
+            owner_log.error('Exception in repeated schedule:', exc_info=True)
+
+        finished = loop.time()
+        self.runs += 1
+        self.last_runtime = finished - started
+        self.max_runtime = max(self.max_runtime, self.last_runtime)
+        self.total_runtime += self.last_runtime
+
+        if self._cancelled:
+            return
+
+        if not self.fixed_rate:
+            self._schedule(finished + self.period)
+            return
+
+        self._tick += 1
+        due = self._start + self._tick * self.period
+
+        if due >= finished:
+            self._schedule(due)
+            return
+
+        # Index of the latest tick that has already passed
+        latest = int((finished - self._start) // self.period)
+
+        if self.missed == 'skip':
+            self.skipped += latest - self._tick + 1
+            self._tick = latest + 1
+            self._schedule(self._start + self._tick * self.period)
+
+        elif self.missed == 'coalesce':
+            self.skipped += latest - self._tick
+            self._tick = latest
+            self._schedule(self._start + self._tick * self.period)
+
+        else:
+            self._schedule(due)
+
+
+class JobStore:
+    # Scheduled jobs that survive restarts, stored in the scheduled_jobs table.
+    # A job is a module name, the name of a coroutine method on that module, pickled arguments
+    # and a due time (unix timestamp). The method is looked up on whatever instance of the module
+    # is loaded when the job is due, so jobs also survive module reloads.
+    #
+    # When a module is loaded, its future jobs are put on the in-memory scheduler, and jobs that
+    # became due while the bot was down are caught up in batches, with limited concurrency.
+    # Rows are deleted once the job has run (even if it failed), so a job that was interrupted
+    # by a restart runs again.
+
+    catch_up_batch_size = 50
+    catch_up_concurrency = 5
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        # row id -> ScheduledJob, for jobs on the in-memory scheduler
+        self._jobs = {}
+
+        # Modules that have rows in the table, so we can skip the query for all the others
+        self._modules_with_jobs = set()
+        self._catch_up_limit = asyncio.Semaphore(self.catch_up_concurrency)
+
+    async def preload(self):
+        rows = await self.bot.db.fetchall('SELECT DISTINCT module FROM scheduled_jobs;')
+        self._modules_with_jobs = {module for module, in rows}
+
+    def has_jobs(self, module_name):
+        return module_name in self._modules_with_jobs
+
+    async def add(self, module, handler, args, due):
+        args = pickle.dumps(args)
+
+        async with self.bot.db.transaction() as tx:
+            async with tx.execute('INSERT INTO scheduled_jobs (module, handler, args, due) VALUES (?, ?, ?, ?);', (module.name, handler, args, due)) as cursor:
+                job_id = cursor.lastrowid
+
+        self._modules_with_jobs.add(module.name)
+        self._schedule(module, job_id, handler, args, due)
+        return job_id
+
+    async def cancel(self, module, job_id):
+        # Only jobs of the module itself can be cancelled. Returns whether there was such a job.
+        async with self.bot.db.transaction() as tx:
+            async with tx.execute('DELETE FROM scheduled_jobs WHERE id = ? AND module = ?;', (job_id, module.name)) as cursor:
+                deleted = cursor.rowcount > 0
+
+        if deleted and (job := self._jobs.pop(job_id, None)):
+            job.cancel()
+
+        return deleted
+
+    async def restore(self, module):
+        if module.name not in self._modules_with_jobs:
+            return
+
+        now = time.time()
+        rows = await self.bot.db.fetchall('SELECT id, handler, args, due FROM scheduled_jobs WHERE module = ? AND due > ?;', (module.name, now))
+
+        for job_id, handler, args, due in rows:
+            self._schedule(module, job_id, handler, args, due)
+
+        if rows:
+            module.log.info(f'Restored {len(rows)} scheduled jobs')
+
+        self.bot.scheduler.schedule_in(0, self._catch_up, module, now, owner=module)
+
+    def _schedule(self, module, job_id, handler, args, due):
+        delay = due - time.time()
+        self._jobs[job_id] = self.bot.scheduler.schedule_in(delay, self._run, module.name, job_id, handler, args, owner=module)
+
+    async def _catch_up(self, module, now):
+        # Keyset pagination over (due, id), so rows deleted by finished jobs don't shift the batches
+        last = (float('-inf'), 0)
+        count = 0
+
+        while True:
+            rows = await self.bot.db.fetchall('''
+                SELECT id, handler, args, due FROM scheduled_jobs
+                WHERE module = ? AND due <= ? AND (due, id) > (?, ?)
+                ORDER BY due, id LIMIT ?;''', (module.name, now, *last, self.catch_up_batch_size))
+
+            if not rows:
+                break
+
+            await asyncio.gather(*(self._run_limited(module.name, job_id, handler, args) for job_id, handler, args, _ in rows))
+            count += len(rows)
+            last = rows[-1][3], rows[-1][0]
+
+        if count:
+            module.log.info(f'Caught up on {count} overdue scheduled jobs')
+
+    async def _run_limited(self, module_name, job_id, handler, args):
+        async with self._catch_up_limit:
+            await self._run(module_name, job_id, handler, args)
+
+    async def _run(self, module_name, job_id, handler, args):
+        self._jobs.pop(job_id, None)
+        module = self.bot.modules.get(module_name)
+
+        if module is None:
+            # Will be restored when the module is loaded again
+            return
+
+        try:
+            await getattr(module, handler)(*pickle.loads(args))
+
+        except asyncio.CancelledError:
+            # Interrupted by an unload or shutdown, keep it so it runs again
+            raise
+
+        except Exception:
+            module.log.error(f'Exception in scheduled job {handler!r}:', exc_info=True)
+
+        async with self.bot.db.transaction() as tx:
+            await tx.execute('DELETE FROM scheduled_jobs WHERE id = ?;', (job_id, ))
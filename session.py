@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+import discord
+from discord.http import Route
+
+
+log = logging.getLogger('bot')
+
+
+# Handing the gateway session over from one process to the next, so restarts don't start from scratch.
+#
+# Starting normally means IDENTIFYing: Discord sends READY and then every guild, and because we have the
+# members intent, the members of every guild are requested before on_ready. On large guilds that takes minutes.
+#
+# Instead, when the restart command shuts us down, close() saves the session id and sequence number, and closes
+# the connection with a code that keeps the session alive. If the next process starts within the resume window,
+# it rebuilds the part of the cache that READY would have given it over REST, and RESUMEs the session, which
+# replays the events it missed. Members are requested in the background afterwards. If the session can't be
+# resumed anymore, Discord invalidates it and discord.py IDENTIFYs as usual.
+#
+# Only restarts hand the session over. Otherwise close() ends it like discord.py does.
+
+# Seconds after closing that we try to resume. Discord doesn't say how long sessions stay resumable.
+max_age = 120
+
+# Concurrent guilds when rebuilding the cache, each takes three requests
+rebuild_concurrency = 5
+
+# What save() writes, anything else isn't resumed
+fields = {'session_id', 'sequence', 'gateway', 'saved_at', 'guild_ids'}
+
+
+def save(path, ws, guild_ids):
+    data = {
+        'session_id': ws.session_id,
+        'sequence': ws.sequence,
+        'gateway': ws.gateway,
+        'saved_at': time.time(),
+        'guild_ids': list(guild_ids),
+    }
+
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+
+    os.replace(tmp_path, path)
+
+
+def take(path):
+    # Returns the saved session, or None if there is none or it is too old.
+    # The file is deleted either way, a session can only be taken over once.
+    try:
+        with open(path) as f:
+            data = json.load(f)
+
+    except FileNotFoundError:
+        return None
+
+    except (OSError, ValueError):
+        log.warning(f'Could not read saved session {str(path)!r}', exc_info=True)
+        data = None
+
+    try:
+        os.remove(path)
+
+    except OSError:
+        pass
+
+    if data is None:
+        return None
+
+    if not isinstance(data, dict) or not fields <= data.keys():
+        log.warning(f'Saved session {str(path)!r} is incomplete, not resuming it')
+        return None
+
+    age = time.time() - data['saved_at']
+    if not 0 <= age <= max_age:
+        log.info(f'Saved session is {age:.0f} s old, not resuming it')
+        return None
+
+    return data
+
+
+async def rebuild_cache(bot, data):
+    # Fills the cache with what READY and the GUILD_CREATEs would have: our user, and the guilds
+    # of the saved session with their channels, roles, emojis and our own member.
+    state = bot._connection
+    http = bot.http
+
+    state.user = user = discord.ClientUser(state=state, data=await http.request(Route('GET', '/users/@me')))
+    state._users[user.id] = user
+
+    limit = asyncio.Semaphore(rebuild_concurrency)
+
+    async def fetch(guild_id):
+        async with limit:
+            try:
+                guild_data, channels, me = await asyncio.gather(
+                    http.get_guild(guild_id), http.get_all_guild_channels(guild_id), http.get_member(guild_id, user.id))
+
+            except (discord.NotFound, discord.Forbidden):
+                # Left the guild in the meantime
+                return
+
+        guild_data['channels'] = channels
+        guild = state._add_guild_from_data(guild_data)
+        guild._add_member(discord.Member(data=me, guild=guild, state=state))
+
+    await asyncio.gather(*(fetch(guild_id) for guild_id in data['guild_ids']))
+
+
+async def chunk_guilds(bot, timeout=60.0):
+    # Requests the members of every guild, one guild at a time, like discord.py does before READY
+    for guild in bot.guilds:
+        if guild.chunked:
+            continue
+
+        try:
+            await asyncio.wait_for(guild.chunk(), timeout)
+
+        except asyncio.TimeoutError:
+            log.warning(f'Timed out requesting the members of guild {guild.id}')
+
+        except Exception:
+            log.warning(f'Could not request the members of guild {guild.id}', exc_info=True)
+
+    log.info(f'Requested the members of {len(bot.guilds)} guilds')
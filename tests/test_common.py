@@ -0,0 +1,59 @@
+import asyncio
+import itertools
+
+from common import TRUNCATION_MARKER, paginate, iter_pages, apaginate
+
+
+def test_pages_fit_max_size():
+    content = '\n'.join(f'line {n}' for n in range(500)) + '\n' + 'x' * 5000
+    pages = paginate(content, max_size=200)
+
+    assert all(len(page) <= 200 for page in pages)
+    assert all(page.startswith('```py\n') and page.endswith('```') for page in pages)
+
+    # Nothing is lost, long lines are only wrapped
+    text = ''.join(page[len('```py\n'):-len('```')].replace('\n', '') for page in pages)
+    assert text == content.replace('\n', '')
+
+
+def test_empty_content_is_one_page():
+    assert paginate('') == ['```py\n```']
+    assert paginate(iter([])) == ['```py\n```']
+
+
+def test_budget_truncates_last_page():
+    pages = paginate('\n'.join(str(n) for n in range(1000)), max_size=100, max_pages=3)
+
+    assert len(pages) == 3
+    assert pages[-1].endswith(f'\n{TRUNCATION_MARKER}```')
+    assert len(pages[-1]) <= 100
+    assert not any(TRUNCATION_MARKER in page for page in pages[:-1])
+
+
+def test_content_that_fits_the_budget_is_not_truncated():
+    content = '\n'.join(str(n) for n in range(100))
+    pages = paginate(content, max_size=100)
+
+    # Exactly as many pages as the budget, and nothing left over
+    assert paginate(content, max_size=100, max_pages=len(pages)) == pages
+    assert not any(TRUNCATION_MARKER in page for page in pages)
+
+
+def test_iterators_are_read_only_as_far_as_the_budget():
+    items = itertools.count()
+    pages = list(iter_pages(items, max_size=100, max_pages=2))
+
+    assert len(pages) == 2 and pages[-1].endswith(f'{TRUNCATION_MARKER}```')
+    # Less than a page more than what was shown
+    assert next(items) < 100
+
+
+def test_async_iterables():
+    async def items():
+        for n in range(1000):
+            yield n
+
+    async def main():
+        return [page async for page in apaginate(items(), max_size=100, max_pages=2)]
+
+    assert asyncio.run(main()) == paginate(iter(range(1000)), max_size=100, max_pages=2)
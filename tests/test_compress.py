@@ -0,0 +1,33 @@
+from pathlib import Path
+
+import pytest
+
+import modules.compress as cc
+
+
+fixtures = Path(__file__).parent / 'fixtures'
+
+sample = b'import asyncio\nresult = await ctx.send("hello")\nreturn [guild.name for guild in bot.guilds]\n' * 3
+
+
+def test_zlib_dict_v1_fixture():
+    # Encoded when the zlib-dict-v1 codec was added. If this fails, zdict_v1.bin changed,
+    # and every payload encoded with it so far can't be decoded anymore.
+    payload = (fixtures / 'zlib_dict_v1_payload.txt').read_text()
+
+    assert payload[0] == 'd'
+    assert cc.base32768_decode_bytes(payload) == (fixtures / 'zlib_dict_v1_source.txt').read_bytes()
+
+
+def test_round_trip():
+    for codec in cc.codecs.values():
+        assert cc.base32768_decode_bytes(cc.base32768_encode_bytes(sample, codec)) == sample, codec
+
+
+def test_short_input_uses_dictionary():
+    assert cc.base32768_encode_bytes(sample)[0] == 'd'
+
+
+def test_codec_is_abstract():
+    with pytest.raises(TypeError):
+        cc.Codec('?', 'incomplete')
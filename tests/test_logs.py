@@ -0,0 +1,50 @@
+import io
+import logging
+import threading
+
+import pytest
+
+import logs
+
+
+def test_message_is_merged_by_logger_and_formatted_by_listener(monkeypatch):
+    # Not by pytest's handlers either
+    monkeypatch.setattr(logging.getLogger('logs_test'), 'propagate', False)
+    stream = io.StringIO()
+    str_threads = []
+    format_threads = []
+
+    class Value:
+        def __str__(self):
+            str_threads.append(threading.current_thread())
+            return '42'
+
+    class Formatter(logging.Formatter):
+        def format(self, record):
+            format_threads.append(threading.current_thread())
+            return super().format(record)
+
+    with logs.LogPipeline({'logs_test': logging.INFO}, stream=stream) as pipeline:
+        pipeline.listener.handlers[0].setFormatter(Formatter(logs.log_format))
+        logging.getLogger('logs_test').info('value %s', Value())
+
+        try:
+            raise ZeroDivisionError
+
+        except ZeroDivisionError:
+            logging.getLogger('logs_test').exception('failed')
+
+    output = stream.getvalue()
+    assert 'logs_test: value 42' in output
+    assert 'logs_test: failed\nTraceback' in output and 'ZeroDivisionError' in output
+    assert str_threads == [threading.current_thread()]
+    assert len(format_threads) == 2 and threading.current_thread() not in format_threads
+
+
+def test_invalid_level_sets_none():
+    logging.getLogger('logs_test.a').setLevel(logging.INFO)
+
+    with pytest.raises(ValueError):
+        logs.apply_levels({'logs_test.a': 'debug', 'logs_test.b': 'loud'})
+
+    assert logging.getLogger('logs_test.a').level == logging.INFO
@@ -0,0 +1,67 @@
+import asyncio
+
+import pytest
+
+from outbox import Outbox
+
+
+class Channel:
+    def __init__(self, id=1, fail=False):
+        self.id = id
+        self.fail = fail
+        self.sent = []
+
+    async def send(self, content):
+        await asyncio.sleep(0)
+        if self.fail:
+            raise RuntimeError('send failed')
+
+        self.sent.append(content)
+        return len(self.sent)
+
+
+def test_burst_is_merged():
+    async def main():
+        outbox = Outbox(window=0.01)
+        channel = Channel()
+        other = Channel(id=2)
+
+        futures = [outbox.send(channel, n) for n in range(5)]
+        futures.append(outbox.send(other, 'other'))
+        await outbox.flush()
+        return outbox, channel, other, [f.result() for f in futures]
+
+    outbox, channel, other, messages = asyncio.run(main())
+
+    assert channel.sent == ['0\n1\n2\n3\n4'] and other.sent == ['other']
+    assert messages == [1, 1, 1, 1, 1, 1]
+    assert outbox.stats() == {'queued': 6, 'sent': 2, 'saved': 4, 'failed': 0, 'channels': 0}
+
+
+def test_messages_stay_under_max_size():
+    async def main():
+        outbox = Outbox(window=0.01, max_size=10)
+        channel = Channel()
+
+        for content in ('aaaa', 'bbbb', 'cccc', 'dddddddddd'):
+            outbox.send(channel, content)
+
+        await outbox.flush()
+        return channel
+
+    assert asyncio.run(main()).sent == ['aaaa\nbbbb', 'cccc', 'dddddddddd']
+
+
+def test_failed_send_is_raised_to_every_sender():
+    async def main():
+        outbox = Outbox(window=0.01)
+        futures = [outbox.send(Channel(fail=True), n) for n in range(2)]
+        await outbox.flush()
+
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result()
+
+        return outbox.stats()
+
+    assert asyncio.run(main())['failed'] == 2
@@ -0,0 +1,92 @@
+import types
+
+import pytest
+
+import ratelimit
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(ratelimit.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def command(name, *limits):
+    async def callback(ctx):
+        pass
+
+    for limit in limits:
+        ratelimit.add_limit(callback, limit)
+
+    return types.SimpleNamespace(callback=callback, qualified_name=name)
+
+
+def context(user=1, channel=10, guild=None):
+    return types.SimpleNamespace(
+        author=types.SimpleNamespace(id=user),
+        channel=types.SimpleNamespace(id=channel),
+        guild=guild and types.SimpleNamespace(id=guild))
+
+
+def test_rate_limit_refills(clock):
+    limiter = ratelimit.RateLimiter()
+    ping = command('ping', ratelimit.RateLimit(2, 10))
+
+    assert limiter.acquire(context(), ping) is not None
+    assert limiter.acquire(context(), ping) is not None
+    assert limiter.acquire(context(), ping) is None
+
+    # Other users have their own bucket
+    assert limiter.acquire(context(user=2), ping) is not None
+
+    clock[0] = 5
+    assert limiter.acquire(context(), ping) is not None
+    assert limiter.acquire(context(), ping) is None
+    assert limiter.rejected == {'ping': 2}
+
+
+def test_rejection_takes_nothing(clock):
+    limiter = ratelimit.RateLimiter()
+    ping = command('ping', ratelimit.RateLimit(1, 10), ratelimit.RateLimit(1, 10, scope='channel'))
+
+    assert limiter.acquire(context(user=1), ping) is not None
+    # Rejected by the channel limit, so the user limit of user 2 is untouched
+    assert limiter.acquire(context(user=2), ping) is None
+    assert limiter.acquire(context(user=2, channel=11), ping) is not None
+
+
+def test_concurrency_limit_is_released(clock):
+    limiter = ratelimit.RateLimiter()
+    build = command('build', ratelimit.ConcurrencyLimit(1))
+
+    release = limiter.acquire(context(user=1), build)
+    assert limiter.acquire(context(user=2), build) is None
+
+    release()
+    assert limiter.acquire(context(user=2), build) is not None
+
+
+def test_limits_are_per_command(clock):
+    # A group's limit doesn't apply to its subcommands, the invoking code passes the command that runs
+    limiter = ratelimit.RateLimiter()
+    group = command('tag', ratelimit.RateLimit(1, 60))
+    subcommand = command('tag show', ratelimit.RateLimit(3, 60))
+
+    assert limiter.acquire(context(), group) is not None
+    assert limiter.acquire(context(), group) is None
+    assert all(limiter.acquire(context(), subcommand) is not None for _ in range(3))
+
+
+def test_idle_buckets_are_evicted(clock):
+    limiter = ratelimit.RateLimiter()
+    slow = command('slow', ratelimit.RateLimit(1, 3600))
+    fast = command('fast', ratelimit.RateLimit(1, 1))
+
+    # A bucket that stays in use for a long time doesn't keep the others around
+    limiter.acquire(context(user=0), slow)
+    for user in range(1000):
+        clock[0] += 0.01
+        limiter.acquire(context(user=user), fast)
+
+    assert len(limiter) < 200
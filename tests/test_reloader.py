@@ -0,0 +1,144 @@
+import os
+import sys
+import itertools
+
+import pytest
+
+from reloader import Reloader
+
+
+_packages = itertools.count()
+
+
+@pytest.fixture
+def package(tmp_path, monkeypatch):
+    # A fresh package with a modules subpackage on sys.path, with a unique name so tests don't share modules
+    name = f'reloader_test_{next(_packages)}'
+    modules = tmp_path / name / 'modules'
+    modules.mkdir(parents=True)
+    (tmp_path / name / '__init__.py').write_text('')
+    (modules / '__init__.py').write_text('')
+
+    monkeypatch.syspath_prepend(str(tmp_path))
+    monkeypatch.setattr(sys, 'dont_write_bytecode', True)
+
+    seconds = itertools.count(1)
+
+    def write(file, source):
+        path = modules / file
+        path.write_text(source)
+
+        # The mtime must change even if the test writes faster than the file system's timestamp resolution
+        mtime = path.stat().st_mtime_ns + next(seconds) * 10 ** 9
+        os.utime(path, ns=(mtime, mtime))
+
+    yield name, write
+
+    for module_name in [n for n in sys.modules if n.startswith(name)]:
+        del sys.modules[module_name]
+
+
+def test_reloads_changed_helper_with_importer(package):
+    name, write = package
+    write('helper.py', 'VALUE = 1\n')
+    write('a.py', 'from . import helper\n')
+    write('b.py', 'X = 1\n')
+
+    reloader = Reloader(f'{name}.modules')
+    a, _ = reloader.import_module('a')
+    reloader.import_module('b')
+    assert reloader.import_module('a') == (a, [])
+
+    write('helper.py', 'VALUE = 2\n')
+    assert reloader.outdated() == {f'{name}.modules.helper', f'{name}.modules.a'}
+
+    # Unrelated modules don't reload it
+    assert reloader.import_module('b')[1] == []
+
+    new_a, reloaded = reloader.import_module('a')
+    assert reloaded == [f'{name}.modules.helper', f'{name}.modules.a']
+    assert new_a is not a and new_a.helper.VALUE == 2
+    assert reloader.outdated() == set()
+
+
+def test_touched_file_is_not_reloaded(package):
+    name, write = package
+    write('a.py', 'X = 1\n')
+
+    reloader = Reloader(f'{name}.modules')
+    reloader.import_module('a')
+
+    write('a.py', 'X = 1\n')
+    assert reloader.outdated() == set()
+
+
+def test_change_is_seen_until_reloaded(package):
+    # Checking for changes used to store the new mtime, so the second check missed the change
+    name, write = package
+    write('a.py', 'X = 1\n')
+
+    reloader = Reloader(f'{name}.modules')
+    reloader.import_module('a')
+
+    write('a.py', 'X = 2\n')
+    assert reloader.outdated() == {f'{name}.modules.a'}
+    assert reloader.outdated() == {f'{name}.modules.a'}
+    assert reloader.import_module('a')[0].X == 2
+
+
+def test_failed_reload_keeps_previous_modules(package):
+    name, write = package
+    write('helper.py', 'VALUE = 1\n')
+    write('a.py', 'from . import helper\nVALUE = helper.VALUE\n')
+
+    reloader = Reloader(f'{name}.modules')
+    a, _ = reloader.import_module('a')
+    helper = a.helper
+
+    write('helper.py', 'VALUE = 2\n')
+    write('a.py', 'from . import helper\nVALUE = helper.VALUE\nraise RuntimeError\n')
+
+    with pytest.raises(RuntimeError):
+        reloader.import_module('a')
+
+    assert sys.modules[f'{name}.modules.a'] is a and a.VALUE == 1
+    assert sys.modules[f'{name}.modules.helper'] is helper
+    assert sys.modules[f'{name}.modules'].helper is helper
+
+    # And it's tried again next time
+    write('a.py', 'from . import helper\nVALUE = helper.VALUE\n')
+    assert reloader.import_module('a')[0].VALUE == 2
+
+
+def test_importers_of_reloaded_helper_are_stale(package):
+    name, write = package
+    write('helper.py', 'VALUE = 1\n')
+    write('a.py', 'from . import helper\n')
+    write('b.py', 'from . import helper\n')
+
+    reloader = Reloader(f'{name}.modules')
+    reloader.import_module('a')
+    b, _ = reloader.import_module('b')
+
+    write('helper.py', 'VALUE = 2\n')
+    reloader.import_module('a')
+
+    assert reloader.stale() == {f'{name}.modules.b'}
+    new_b, reloaded = reloader.import_module('b')
+    assert reloaded == [f'{name}.modules.b'] and new_b.helper.VALUE == 2
+    assert reloader.stale() == set()
+
+
+def test_importers_of_files(package, tmp_path):
+    name, write = package
+    write('helper.py', 'VALUE = 1\n')
+    write('a.py', 'from . import helper\n')
+    write('b.py', 'X = 1\n')
+
+    reloader = Reloader(f'{name}.modules')
+    reloader.import_module('a')
+    reloader.import_module('b')
+
+    modules = tmp_path / name / 'modules'
+    assert reloader.importers_of_files([modules / 'helper.py']) == {f'{name}.modules.helper', f'{name}.modules.a'}
+    assert reloader.importers_of_files([modules / 'b.py', modules / 'new.py']) == {f'{name}.modules.b'}
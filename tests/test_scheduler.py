@@ -0,0 +1,75 @@
+import asyncio
+import logging
+
+from scheduler import Scheduler
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_jobs_run_in_order():
+    async def main():
+        scheduler = Scheduler()
+        ran = []
+
+        async def job(n):
+            ran.append(n)
+
+        for n in (3, 1, 2):
+            scheduler.schedule_in(n * 0.01, job, n)
+
+        await asyncio.sleep(0.1)
+        scheduler.close()
+        return ran
+
+    assert run(main()) == [1, 2, 3]
+
+
+def test_failing_jobs_dont_stop_the_dispatcher(caplog):
+    async def main():
+        scheduler = Scheduler()
+        ran = []
+
+        def raises_synchronously():
+            raise RuntimeError('sync')
+
+        async def raises():
+            raise RuntimeError('async')
+
+        async def job():
+            ran.append(True)
+
+        scheduler.schedule_in(0, raises_synchronously)
+        # Wrong number of arguments, so calling it raises before there is a coroutine
+        scheduler.schedule_in(0, job, 'extra')
+        scheduler.schedule_in(0, raises)
+        scheduler.schedule_in(0.02, job)
+
+        await asyncio.sleep(0.1)
+        dispatcher = scheduler._dispatcher
+        scheduler.close()
+        return ran, dispatcher
+
+    with caplog.at_level(logging.ERROR, logger='bot'):
+        ran, dispatcher = run(main())
+
+    assert ran == [True]
+    assert dispatcher.cancelled()
+    assert len([r for r in caplog.records if r.message == 'Exception in scheduled task:']) == 3
+
+
+def test_cancelled_jobs_dont_run():
+    async def main():
+        scheduler = Scheduler()
+        ran = []
+
+        async def job():
+            ran.append(True)
+
+        scheduler.schedule_in(0.01, job).cancel()
+        await asyncio.sleep(0.05)
+        scheduler.close()
+        return ran, len(scheduler)
+
+    assert run(main()) == ([], 0)
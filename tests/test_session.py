@@ -0,0 +1,44 @@
+import json
+import time
+import types
+
+import session
+
+
+ws = types.SimpleNamespace(session_id='abc', sequence=42, gateway='wss://gateway.example')
+
+
+def test_saved_session_is_taken_once(tmp_path):
+    path = tmp_path / 'session.json'
+    session.save(path, ws, [1, 2])
+
+    data = session.take(path)
+    assert data['session_id'] == 'abc' and data['sequence'] == 42 and data['guild_ids'] == [1, 2]
+
+    assert not path.exists()
+    assert session.take(path) is None
+
+
+def test_old_session_is_not_resumed(tmp_path, monkeypatch):
+    path = tmp_path / 'session.json'
+    session.save(path, ws, [])
+
+    later = time.time() + session.max_age + 1
+    monkeypatch.setattr(session.time, 'time', lambda: later)
+    assert session.take(path) is None
+    assert not path.exists()
+
+
+def test_invalid_session_is_not_resumed(tmp_path):
+    path = tmp_path / 'session.json'
+
+    path.write_text(json.dumps({'session_id': 'abc', 'saved_at': time.time()}))
+    assert session.take(path) is None
+    assert not path.exists()
+
+    path.write_text('{not json')
+    assert session.take(path) is None
+    assert not path.exists()
+
+    path.write_text('[]')
+    assert session.take(path) is None
@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import textwrap
+import traceback
+import multiprocessing
+import collections.abc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, workers just won't have a memory limit there
+    resource = None
+
+from discord.backoff import ExponentialBackoff
+
+
+log = logging.getLogger('bot')
+
+
+# A pool of worker processes for running code that shouldn't run on the event loop, like eval --worker.
+# Workers are started once and reused. Each job gets a timeout, after which the worker is killed (and replaced),
+# and workers have a limit on their address space, so runaway code can't take the bot down.
+# The timeout only counts the time spent waiting for the worker, not the time the caller takes with the results.
+# Results are pickled back to us. Iterators are sent one item at a time, so results can be used while
+# they are still being computed, and things that can't be pickled are sent as their repr.
+
+
+class WorkerError(Exception):
+    # The code raised an exception, or the worker died. The message is the worker's traceback.
+    pass
+
+
+class WorkerTimeout(WorkerError):
+    pass
+
+
+def _send(conn, kind, value):
+    try:
+        conn.send((kind, value))
+
+    except Exception:
+        # Connection.send pickles everything before writing, so nothing was sent yet
+        conn.send((kind, repr(value)))
+
+
+def _run_job(conn, mode, code):
+    env = {'__name__': f'__{mode}__'}
+
+    if mode == 'eval':
+        result = eval(compile(code, f'<{mode}>', 'eval'), env)
+
+    else:
+        exec(compile(f'def _func():\n{textwrap.indent(code, "    ")}', f'<{mode}>', 'exec'), env)
+        result = env['_func']()
+
+        # Like exec, only reply if something was returned
+        if result is None:
+            return
+
+    if isinstance(result, collections.abc.Iterator):
+        for item in result:
+            _send(conn, 'item', item)
+
+    else:
+        _send(conn, 'item', result)
+
+
+def _worker_main(conn, memory_limit):
+    if resource is not None and memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    while True:
+        try:
+            mode, code = conn.recv()
+
+        except EOFError:
+            return
+
+        try:
+            _run_job(conn, mode, code)
+
+        except (Exception, SystemExit):
+            conn.send(('error', traceback.format_exc()))
+
+        else:
+            conn.send(('done', None))
+
+
+class _Worker:
+    __slots__ = ('process', 'conn')
+
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+
+
+class WorkerPool:
+    def __init__(self, size=2, *, memory_limit=512 * 1024 * 1024):
+        self.size = size
+        self.memory_limit = memory_limit
+
+        # forkserver starts workers from a clean process instead of forking the whole bot
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        self.context = multiprocessing.get_context(method)
+        if method == 'forkserver':
+            self.context.set_forkserver_preload([__name__])
+
+        self._idle = None
+        self._workers = set()
+        self._background = set()
+        self._closed = False
+
+    async def _spawn(self):
+        parent_conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=_worker_main, args=(child_conn, self.memory_limit), name='gs6ex-worker', daemon=True)
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, process.start)
+
+        except BaseException:
+            parent_conn.close()
+            raise
+
+        finally:
+            child_conn.close()
+
+        worker = _Worker(process, parent_conn)
+        self._workers.add(worker)
+        return worker
+
+    async def _start(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.size):
+                try:
+                    self._idle.put_nowait(await self._spawn())
+
+                except Exception:
+                    log.exception('Failed to start a worker')
+                    self._in_background(self._replace())
+
+    def _in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _reap(self, worker):
+        # Closing the connection only after the process is gone, a thread may still be reading from it
+        await asyncio.get_running_loop().run_in_executor(None, worker.process.join)
+        worker.conn.close()
+
+    async def _replace(self):
+        # Starting a process can fail for a while (e.g. out of memory or process slots), so this keeps trying.
+        # Otherwise the pool would be a worker short for good, and run would wait forever once they're all gone.
+        backoff = ExponentialBackoff()
+
+        while not self._closed:
+            try:
+                worker = await self._spawn()
+
+            except Exception:
+                retry = backoff.delay()
+                log.exception(f'Failed to start a worker, retrying in {retry:.2f} seconds')
+                await asyncio.sleep(retry)
+
+            else:
+                if self._closed:
+                    self._kill(worker)
+
+                else:
+                    self._idle.put_nowait(worker)
+
+                return
+
+    def _kill(self, worker):
+        self._workers.discard(worker)
+        worker.process.kill()
+        self._in_background(self._reap(worker))
+
+    async def run(self, mode, code, *, timeout=10.0):
+        # Runs code ('eval' mode: an expression, 'exec' mode: a function body) in a worker.
+        # This is an async generator of the results, raising WorkerError if the code raised,
+        # and WorkerTimeout if we waited for the worker for more than timeout seconds in total.
+        await self._start()
+        worker = await self._idle.get()
+
+        loop = asyncio.get_running_loop()
+        remaining = timeout
+        finished = False
+
+        try:
+            worker.conn.send((mode, code))
+
+            while True:
+                start = loop.time()
+
+                try:
+                    receive = loop.run_in_executor(None, worker.conn.recv)
+                    kind, value = await asyncio.wait_for(receive, max(0.0, remaining))
+
+                except asyncio.TimeoutError:
+                    raise WorkerTimeout(f'Timed out after {timeout:g} seconds') from None
+
+                except (EOFError, OSError):
+                    raise WorkerError(f'Worker died with exit code {worker.process.exitcode}') from None
+
+                # Time spent in the yield below, e.g. sending the result, doesn't count
+                remaining -= loop.time() - start
+
+                if kind == 'item':
+                    yield value
+
+                elif kind == 'done':
+                    finished = True
+                    return
+
+                else:
+                    finished = True
+                    raise WorkerError(value)
+
+        finally:
+            # A worker that didn't finish its job (timed out, died, or the caller stopped reading) is killed
+            if finished:
+                self._idle.put_nowait(worker)
+
+            else:
+                self._kill(worker)
+                self._in_background(self._replace())
+
+    def close(self):
+        self._closed = True
+
+        for worker in list(self._workers):
+            self._kill(worker)